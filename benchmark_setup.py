@@ -0,0 +1,59 @@
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from modules.run import load_config
+from modules.data import DataManager
+
+# Times DataManager(config) with the previous row-by-row file_is_valid and
+# _format_dataframe_for_flow against the vectorized versions, without the
+# metadata cache so both build their dataframes.
+
+def legacy_file_is_valid(self, dataframe, directory):
+    filenames = self._extract_filenames(directory)
+    valid = []
+    for i in dataframe.index:
+        fname = self._format_filename(i, int(dataframe['id'].loc[i]))
+        valid.append(fname in filenames)
+    return np.array(valid)
+
+def legacy_format_dataframe_for_flow(self, country, suffix=None):
+    classes = map(str, self.dataframes[country]["label"]) if country == 'kenya' else self.dataframes[country]["class"]
+    return pd.DataFrame(
+        list(map(
+            lambda e: (self._format_filename(e[0], e[1], suffix=suffix), e[2]), 
+            zip(
+                self.dataframes[country].index, 
+                map(int, self.dataframes[country]["id"]),
+                classes,
+            )
+        )),
+        columns=["filename", "class"]
+    )
+
+class LegacyDataManager(DataManager):
+    file_is_valid = legacy_file_is_valid
+    _format_dataframe_for_flow = legacy_format_dataframe_for_flow
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", default="cls_final_xception_kenya_rgb")
+args = parser.parse_args()
+
+config = dict(load_config(args.config), cache_metadata=False)
+
+legacy, legacy_setup = timed(LegacyDataManager, config)
+current, current_setup = timed(DataManager, config)
+print(f"DataManager(config) setup: before {legacy_setup:.2f}s, after {current_setup:.2f}s")
+
+for country in sorted(current._setup_countries):
+    before, before_time = timed(legacy._format_dataframe_for_flow, country)
+    after, after_time = timed(current._format_dataframe_for_flow, country)
+    assert before.equals(after[["filename", "class"]])
+    print(f"{country} _format_dataframe_for_flow ({len(after)} rows): before {before_time:.3f}s, after {after_time:.3f}s")
@@ -0,0 +1,94 @@
+import os
+import time
+import argparse
+
+# CPU benchmark, hide any accelerator before tensorflow is imported
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from modules.run import load_config, Runner, Trainer
+from modules.models import pretrained_cnn
+
+# Times training steps of every Xception/ResNet/VGG backbone pretrained_cnn_module
+# supports, in float32 and with the mixed_precision and xla config switches.
+
+TYPES = [
+    "Xception",
+    "ResNet50", "ResNet101", "ResNet152",
+    "ResNet50V2", "ResNet101V2", "ResNet152V2",
+    "VGG16", "VGG19",
+]
+
+MODES = {
+    "float32": (False, False),
+    "xla": (False, True),
+    "mixed_bfloat16": ("mixed_bfloat16", False),
+    "mixed_bfloat16+xla": ("mixed_bfloat16", True),
+    "mixed_float16": ("mixed_float16", False),
+    "mixed_float16+xla": ("mixed_float16", True),
+}
+
+def benchmark(config, steps, warmup):
+    # compiled by the Trainer, so the benchmark runs the training step Trainer.fit runs
+    tf.keras.backend.clear_session()
+    trainer = Trainer(config)
+    config = trainer.config
+
+    model = pretrained_cnn(config, config["image_size"], config["n_channels"], strategy=trainer.strategy)
+    trainer.compile(model)
+
+    batch_size = config["batch_size"]
+    images = np.random.randint(0, 256, (batch_size, config["image_size"], config["image_size"], config["n_channels"])).astype(np.float32)
+    labels = np.eye(config["n_classes"], dtype=np.float32)[np.random.randint(0, config["n_classes"], batch_size)]
+
+    for _ in range(warmup):
+        model.train_on_batch(images, labels)
+
+    start = time.time()
+    for _ in range(steps):
+        model.train_on_batch(images, labels)
+    step_time = (time.time() - start) / steps
+
+    return step_time, batch_size / step_time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", default="cls_final_xception_kenya_rgb")
+parser.add_argument("--types", nargs="+", default=TYPES)
+parser.add_argument("--modes", nargs="+", default=["float32", "xla", "mixed_bfloat16", "mixed_bfloat16+xla"], help=", ".join(MODES))
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--image-size", type=int, default=224)
+parser.add_argument("--steps", type=int, default=5)
+parser.add_argument("--warmup", type=int, default=2)
+parser.add_argument("--output", default=None, help="csv file for the results")
+args = parser.parse_args()
+
+config = load_config(args.config)
+
+rows = []
+for pretrained_type in args.types:
+    for mode in args.modes:
+        precision, xla = MODES[mode]
+        run_config = dict(
+            config,
+            name=f"{config['name']}_benchmark",
+            pretrained=dict(config["pretrained"], type=pretrained_type, weights=None),
+            batch_size=args.batch_size,
+            image_size=args.image_size,
+            n_channels=3,
+            mixed_precision=precision,
+            xla=xla,
+        )
+        step_time, throughput = benchmark(run_config, args.steps, args.warmup)
+        rows.append({"type": pretrained_type, "mode": mode, "step_time": step_time, "images_per_second": throughput})
+        print(f"{pretrained_type} {mode}: {step_time * 1000:.0f} ms/step, {throughput:.1f} images/s")
+
+# back to the defaults for anything run after this in the same process
+Runner(dict(config, mixed_precision=False, xla=False))
+
+results = pd.DataFrame(rows)
+print(results.pivot(index="type", columns="mode", values="images_per_second").to_string())
+if args.output is not None:
+    results.to_csv(args.output, index=False)
@@ -0,0 +1,34 @@
+import argparse
+
+import modules
+
+parser = argparse.ArgumentParser(description="Evaluate every checkpoint on every target dataset and write one result table.")
+parser.add_argument("--config", required=True, help="config of the architecture the checkpoints were trained with")
+parser.add_argument("--checkpoints", nargs="+", required=True)
+parser.add_argument("--targets", nargs="+", default=["kenya", "peru"], help="country, or country:config to use the data settings of another config")
+parser.add_argument("--subset", default="validation", help="validation or all")
+parser.add_argument("--cache-dir", default=None, help="memory-map the decoded targets here instead of holding them in memory")
+parser.add_argument("--output", default=None, help="csv file for the result table")
+args = parser.parse_args()
+
+config = modules.run.load_config(args.config)
+
+targets = []
+for target in args.targets:
+    if ":" in target:
+        country, target_config = target.split(":", 1)
+        targets.append((country, modules.run.load_config(target_config)))
+    else:
+        targets.append(target)
+
+results = modules.run.evaluate.evaluate_cross_domain(
+    config,
+    args.checkpoints,
+    targets,
+    subset=None if args.subset == "all" else args.subset,
+    cache_dir=args.cache_dir
+)
+
+print(results.to_string(index=False))
+if args.output is not None:
+    results.to_csv(args.output, index=False)
@@ -1,28 +1,14 @@
-import cv2
-import os
-import numpy as np
-import matplotlib.pyplot as plt
+import argparse
 
-#x = os.listdir('data/kenya/kenya_1000x1000_images')
-x = os.listdir('data/peru/224/cropped')
+import modules
 
-corrupt = open('data/peru/corrupt.txt', 'w')
-cloud = open('data/peru/cloudy.txt', 'w')
-gray = open('data/peru/grayscale.txt', 'w')
+parser = argparse.ArgumentParser(description="Build or update the cloudy/grayscale/corrupt quality index of an image directory.")
+parser.add_argument("--country", default="peru")
+parser.add_argument("--size", type=int, default=224)
+parser.add_argument("--resizing", default="cropped")
+parser.add_argument("--workers", type=int, default=None)
+args = parser.parse_args()
 
-for idx, el in enumerate(x):
-    if idx % 1000 == 0:
-        print(idx)
-    img = cv2.imread('data/peru/224/cropped/' + el, cv2.IMREAD_COLOR)
-    if img is None:
-        corrupt.write(el + '\n')
-    else:
-        rgb_mean = list(cv2.mean(img))[:-1]
-        if all(i > 150 for i in rgb_mean):
-            cloud.write(el + '\n')
-        elif rgb_mean.count(rgb_mean[0]) == len(rgb_mean):
-            gray.write(el + '\n')
+index = modules.data.quality.build_index(args.country, args.size, args.resizing, workers=args.workers)
 
-corrupt.close()
-cloud.close()
-gray.close()
+print(f"{len(index)} images: {index['corrupt'].sum()} corrupt, {index['cloudy'].sum()} cloudy, {index['grayscale'].sum()} grayscale")
@@ -1 +1,4 @@
 from modules.analysis.analysis import *
+
+from modules.analysis import activations
+from modules.analysis import filters
@@ -0,0 +1,162 @@
+import os
+import time
+import weakref
+
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.keras import Input, Model, Sequential
+from tensorflow.keras.layers import InputLayer
+
+from modules.data import util
+
+# activations of several layers for batches of images, through one cached truncated model per (model, layers)
+
+_extractors = weakref.WeakKeyDictionary()
+
+def _nested(layer, names):
+    # requested layers inside a nested model, e.g. the backbone of pretrained_cnn
+    if not isinstance(layer, Model):
+        return []
+    inner = {l.name for l in layer.layers}
+    return [name for name in names if name in inner]
+
+def activation_model(model, layers):
+    """
+    Model from the input of model to the outputs of layers (a list of layer
+    names), in that order, that stops after the last of them. Layers of a
+    nested model (the pretrained backbone of a Sequential pretrained_cnn)
+    can be named directly.
+    """
+    layers = list(layers)
+
+    if not isinstance(model, Sequential):
+        try:
+            return Model(model.inputs, [model.get_layer(name).output for name in layers])
+        except ValueError:
+            raise ValueError(f"Layers {layers} must all be layers of {model.name}.")
+
+    # rebuild the Sequential layer by layer so nested models can expose inner outputs
+    inputs = Input(shape=model.input_shape[1:], dtype=model.inputs[0].dtype)
+    x = inputs
+    outputs = {}
+    for layer in model.layers:
+        if len(outputs) == len(layers):
+            break
+        if isinstance(layer, InputLayer):
+            continue
+
+        inner = _nested(layer, layers)
+        if inner:
+            # the nested model's own output is only needed if a later layer is requested
+            targets = [layer.get_layer(name).output for name in inner]
+            last = len(outputs) + len(inner) == len(layers)
+            values = Model(layer.inputs, targets + ([] if last else list(layer.outputs)))(x)
+            values = values if isinstance(values, (list, tuple)) else [values]
+            outputs.update(zip(inner, values))
+            if not last:
+                x = values[-1]
+        else:
+            x = layer(x)
+            if layer.name in layers:
+                outputs[layer.name] = x
+
+    missing = [name for name in layers if name not in outputs]
+    if missing:
+        raise ValueError(f"Layers {missing} are not layers of {model.name}.")
+    return Model(inputs, [outputs[name] for name in layers])
+
+def _extractor(model, layers, reduce):
+    # cached tf.function of activation_model, reducing spatial maps to per-filter means in-graph
+    if reduce not in ("mean", None):
+        raise ValueError("Parameter \'reduce\' must be one of either \'mean\' or None.")
+
+    key = (tuple(layers), reduce)
+    cache = _extractors.setdefault(model, {})
+    if key not in cache:
+        truncated = activation_model(model, layers)
+        dtype = tf.as_dtype(truncated.inputs[0].dtype)
+
+        # one trace for every batch size, including the last partial batch
+        @tf.function(input_signature=[tf.TensorSpec((None,) + tuple(truncated.input_shape[1:]), dtype)])
+        def extract(images):
+            values = truncated(images, training=False)
+            values = values if isinstance(values, (list, tuple)) else [values]
+            if reduce == "mean":
+                values = [tf.reduce_mean(v, axis=list(range(1, len(v.shape) - 1))) if len(v.shape) > 2 else v for v in values]
+            return values
+
+        cache[key] = lambda images: extract(tf.cast(images, dtype))
+    return cache[key]
+
+def _batches(images, batch_size):
+    # arrays are sliced, datasets/generators of images or (images, labels) batches are iterated
+    if isinstance(images, np.ndarray):
+        for start in range(0, len(images), batch_size):
+            yield images[start:start + batch_size]
+    else:
+        for batch in images:
+            yield batch[0] if isinstance(batch, (list, tuple)) else batch
+
+def extract_activations(model, images, layers, batch_size=32, reduce="mean"):
+    """
+    Activations of layers for every image, as a dict of layer name to
+    array:
+        => reduce="mean": (n_images, n_filters) per-filter means
+        => reduce=None: (n_images, height, width, n_filters) full maps
+    images is an array, or a dataset of images or (images, labels) batches,
+    already preprocessed as model expects.
+    """
+    extract = _extractor(model, layers, reduce)
+
+    values = [[] for _ in layers]
+    for batch in _batches(images, batch_size):
+        for i, value in enumerate(extract(batch)):
+            values[i].append(value.numpy())
+    return {name: np.concatenate(v) for name, v in zip(layers, values)}
+
+def save_activations(model, images, layers, directory, batch_size=32, reduce="mean", n_images=None, filenames=None):
+    """
+    Stream the activations of layers to <directory>/<layer>.npy, one
+    memory-mapped (n_images, ...) array per layer, so memory is bounded by a
+    batch. n_images is required when images is not an array. filenames, if
+    given, are saved to filenames.npy after every layer is complete.
+    """
+    if n_images is None:
+        if not isinstance(images, np.ndarray):
+            raise ValueError("Parameter \'n_images\' is required to stream activations of a dataset.")
+        n_images = len(images)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    extract = _extractor(model, layers, reduce)
+
+    arrays = None
+    offset = 0
+    start = time.time()
+    for batch in _batches(images, batch_size):
+        values = [v.numpy() for v in extract(batch)]
+        if arrays is None:
+            arrays = [
+                util.open_memmap(os.path.join(directory, f"{name}.npy"), v.dtype, (n_images,) + v.shape[1:])
+                for name, v in zip(layers, values)
+            ]
+        n = min(len(values[0]), n_images - offset)
+        for array, value in zip(arrays, values):
+            array[offset:offset + n] = value[:n]
+        offset += n
+        if offset >= n_images:
+            break
+
+    if arrays is None:
+        raise ValueError("Cannot extract activations of an empty dataset.")
+    if offset < n_images:
+        raise ValueError(f"Only {offset} of {n_images} images were extracted.")
+    for name, array in zip(layers, arrays):
+        util.atomic_save(os.path.join(directory, f"{name}.npy"), array)
+
+    if filenames is not None:
+        util.atomic_save(os.path.join(directory, "filenames.npy"), np.asarray(filenames, dtype=str)[:offset])
+
+    print(f"Extracted activations of {offset} images to {directory} in {time.time() - start:.1f}s.")
+    return directory
@@ -0,0 +1,119 @@
+import numpy as np
+import tensorflow as tf
+
+from modules.analysis.activations import activation_model
+
+# input images maximizing filters or output classes, found by gradient ascent on a batch of targets at once
+
+def _ascent(target_model, step, epochs, input_size=None):
+    """
+    tf.function running epochs steps of gradient ascent on a batch of
+    images, image i maximizing channel targets[i] of target_model's output.
+    Images of any size are resized in-graph to input_size, the fixed input
+    of the model if it has one. Returns the images, the last loss of each
+    and whether it ever fell to zero.
+    """
+    channels = target_model.input_shape[-1]
+    epsilon = tf.keras.backend.epsilon()
+
+    def loss(images, targets):
+        inputs = images if input_size is None else tf.image.resize(images, input_size)
+        outputs = tf.gather(target_model(inputs, training=False), targets, axis=-1, batch_dims=1)
+        return tf.reduce_mean(outputs, axis=list(range(1, len(outputs.shape)))) if len(outputs.shape) > 1 else outputs
+
+    @tf.function(input_signature=[tf.TensorSpec((None, None, None, channels), tf.float32), tf.TensorSpec((None,), tf.int32)])
+    def ascend(images, targets):
+        losses = tf.zeros(tf.shape(targets), tf.float32)
+        dead = tf.zeros(tf.shape(targets), tf.bool)
+        for _ in tf.range(epochs):
+            with tf.GradientTape() as tape:
+                tape.watch(images)
+                losses = tf.cast(loss(images, targets), tf.float32)
+                # images are independent, so the gradient of the sum is each image's own gradient
+                total = tf.reduce_sum(losses)
+            grads = tape.gradient(total, images)
+            grads /= tf.sqrt(tf.reduce_mean(tf.square(grads), axis=[1, 2, 3], keepdims=True)) + epsilon
+            images += grads * step
+            # some filters get stuck to 0, they are reported as None
+            dead |= losses <= epsilon
+        return images, losses, dead
+
+    return ascend
+
+@tf.function(input_signature=[tf.TensorSpec((None, None, None, None), tf.float32), tf.TensorSpec((2,), tf.int32)])
+def _upscale(images, size):
+    # clip each image to 2 standard deviations around its mean, as the uint8 round trip of deprocess_image did
+    mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+    std = tf.math.reduce_std(images, axis=[1, 2, 3], keepdims=True) + tf.keras.backend.epsilon()
+    normalized = tf.clip_by_value((images - mean) / std, -2., 2.)
+    return tf.image.resize(normalized, size, method="bicubic") * std + mean
+
+def _deprocess(images):
+    # uint8 images centered on gray with 0.25 standard deviation, per image
+    images = images - images.mean(axis=(1, 2, 3), keepdims=True)
+    images /= images.std(axis=(1, 2, 3), keepdims=True) + tf.keras.backend.epsilon()
+    images = np.clip(images * 0.25 + 0.5, 0, 1)
+    return (images * 255).astype(np.uint8)
+
+def visualize_filters(model,
+                      layer_name=None,
+                      filter_indices=None,
+                      classes=None,
+                      step=1.,
+                      epochs=15,
+                      upscaling_steps=9,
+                      upscaling_factor=1.2,
+                      output_dim=(412, 412),
+                      batch_size=64,
+                      seed=None):
+    """
+    Generate an image maximizing each of filter_indices of layer_name (all
+    filters of the layer if None), or each output class of classes, with
+    batch_size images optimized in parallel.
+
+    Like visualize_layer_filter, images start as gray noise at output_dim
+    shrunk by upscaling_factor ** upscaling_steps and are upscaled after
+    each of the upscaling_steps rounds of epochs steps, which keeps high
+    frequencies from dominating.
+
+    Returns one (uint8 image, loss) per filter or class, None for filters
+    stuck at 0.
+    """
+    if (layer_name is None) == (classes is None):
+        raise ValueError("Exactly one of parameters \'layer_name\' and \'classes\' must be given.")
+    if not tf.as_dtype(model.inputs[0].dtype).is_floating:
+        raise ValueError("Filter visualization requires a model with float inputs, set \'preprocessing: pipeline\'.")
+
+    if classes is not None:
+        target_model, targets = model, list(classes)
+    else:
+        target_model = activation_model(model, [layer_name])
+        targets = list(range(target_model.output_shape[-1])) if filter_indices is None else list(filter_indices)
+
+    input_size = None
+    if None not in target_model.input_shape[1:3]:
+        input_size = tuple(target_model.input_shape[1:3])
+    ascend = _ascent(target_model, step, epochs, input_size)
+
+    dims = [tuple(int(x / (upscaling_factor ** up)) for x in output_dim) for up in range(upscaling_steps, -1, -1)]
+    random = np.random.RandomState(seed)
+
+    results = []
+    for start in range(0, len(targets), batch_size):
+        batch = tf.constant(targets[start:start + batch_size], dtype=tf.int32)
+
+        # we start from a gray image with some random noise
+        images = (random.random_sample((len(batch),) + dims[0] + (target_model.input_shape[-1],)) - 0.5) * 20 + 128
+        images = tf.constant(images, dtype=tf.float32)
+
+        dead = np.zeros(len(batch), dtype=bool)
+        for dim in dims[1:]:
+            images, losses, stuck = ascend(images, batch)
+            dead |= stuck.numpy()
+            images = _upscale(images, tf.constant(dim, dtype=tf.int32))
+
+        images = _deprocess(images.numpy())
+        for image, loss, is_dead in zip(images, losses.numpy(), dead):
+            results.append(None if is_dead else (image, loss))
+
+    return results
@@ -1,4 +1,9 @@
 import os
+import json
+import hashlib
+import warnings
+import threading
+import functools
 
 import tensorflow as tf
 import pandas as pd
@@ -18,8 +23,15 @@ class DataManager:
         self.dataframes = {}
         self.shapefiles = {}
         
+        self._shards = {}
+        self._quality = {}
+        self._filename_index = {}
         self._setup_countries = set()
         
+        # road masks rasterized on the fly (config mask_source: shapefile)
+        self._shapefile_lock = threading.Lock()
+        self._road_mask = functools.lru_cache(maxsize=config.get("mask_cache_size", 4096))(self._rasterize_road_mask)
+        
         if config["use_kenya_images"]:
             self._setup("kenya")
         
@@ -32,28 +44,111 @@ class DataManager:
             raise ValueError("Country must be either \'kenya\' or \'peru\'.")
 
         if country not in self._setup_countries:
-            geo = modules.data.load_geodata(country)
-            osm, sf = modules.data.load_shapefile(country)
-
-            self.shapefiles[country] = sf
-            self.dataframes[country] = pd.DataFrame.merge(geo, osm, on="index")
-
-            classes = [self.config["class_enum"][v] for v in self.dataframes[country]["class"].values]
-            self.dataframes[country]["label"] = classes
+            directory = self._directory(country)
+            
+            cache = None
+            if self.config.get("cache_metadata", True):
+                cache = self._metadata_cache_path(country, directory)
             
-            directory = f"{modules.data.util.root()}/{country}/{self.config['image_size']}/{self.config['resizing']}"
-            valid = self.file_is_valid(self.dataframes[country], directory)
-            self.dataframes[country] = self.dataframes[country][valid]
+            if cache is not None and os.path.exists(cache):
+                self.shapefiles[country] = modules.data.load_shapes(country)
+                self.dataframes[country] = pd.read_pickle(cache)
+            else:
+                geo = modules.data.load_geodata(country)
+                osm, sf = modules.data.load_shapefile(country)
+
+                self.shapefiles[country] = sf
+                if country == "peru":
+                    # every other geodata row, merged on half its index; files are matched by id in flow_dataframe
+                    geo = geo.iloc[::2].reset_index()
+                    geo['index'] = geo['index'] / 2
+                    self.dataframes[country] = pd.DataFrame.merge(geo, osm, on="index")
+                    self.dataframes[country]['index'] = (self.dataframes[country]['index'] * 2).astype('int32')
+                    self.dataframes[country] = self.dataframes[country].set_index(self.dataframes[country]['index'])
+                else:
+                    self.dataframes[country] = pd.DataFrame.merge(geo, osm, on="index")
+
+                classes = [self.config["class_enum"][v] for v in self.dataframes[country]["class"].values]
+                self.dataframes[country]["label"] = classes
+                
+                if country == "kenya":
+                    valid = self.file_is_valid(self.dataframes[country], directory)
+                    self.dataframes[country] = self.dataframes[country][valid]
+                
+                if cache is not None:
+                    modules.data.util.atomic_save(cache, self.dataframes[country])
 
             self._setup_countries.add(country)
+    
+    def _metadata_cache_path(self, country, directory):
+        # keyed on everything _setup reads: source file mtimes, the image listing and the config fields used
+        path = os.path.join(modules.data.util.root(), country)
+        sources = [
+            os.path.join(path, f"{country}_roads_bbox_300m.csv"),
+            os.path.join(path, f"{country}_roads.shp"),
+            os.path.join(path, f"{country}_roads.dbf"),
+            os.path.join(path, f"{country}_roads.shx"),
+            directory,
+        ]
+        key = {
+            "mtimes": [os.path.getmtime(source) for source in sources],
+            "image_size": self.config["image_size"],
+            "resizing": self.config["resizing"],
+            "class_enum": self.config["class_enum"],
+            # 2: the Peru frame is the one flow_dataframe uses
+            "version": 2,
+        }
+        digest = hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+        return os.path.join(path, f"{country}_metadata_{digest}.pkl")
 
     def file_is_valid(self, dataframe, directory):
         filenames = self._extract_filenames(directory)
-        valid = []
-        for i in dataframe.index:
-            fname = self._format_filename(i, int(dataframe['id'].loc[i]))
-            valid.append(fname in filenames)
-        return np.array(valid)
+        return self._format_filenames(dataframe.index, dataframe['id']).isin(filenames).values
+
+    def filter_quality(self, country, dataframe):
+        """
+        Drop cloudy (remove_clouds) and grayscale (remove_grayscale) images
+        with one anti-join. Images are flagged by the cloudy.txt and
+        grayscale.txt lists, unless quality_index is set: then the flags of
+        the modules.data.quality index (built by img_check.py) are used,
+        which also detect clouds and grayscale from the chip means and drop
+        corrupt chips.
+        """
+        flags = self._quality_flags(country)
+        
+        drop = flags["corrupt"].values.copy()
+        if self.config["remove_clouds"]:
+            drop |= flags["cloudy"].values
+        if self.config.get("remove_grayscale", False):
+            drop |= flags["grayscale"].values
+        
+        return dataframe[~dataframe["filename"].isin(flags["filename"].values[drop])]
+    
+    def _quality_flags(self, country):
+        # filename/cloudy/grayscale/corrupt flags of the quality index, or of the legacy lists
+        if country not in self._quality:
+            index = None
+            if self.config.get("quality_index", False):
+                size, resizing = self.config["image_size"], self.config["resizing"]
+                index = modules.data.quality.load_index(country, size, resizing)
+                if index is None:
+                    warnings.warn(f"No quality index for {country}, build it with img_check.py. Using cloudy.txt and grayscale.txt instead.")
+                elif modules.data.quality.is_stale(index, country, size, resizing):
+                    print(f"Images of {country} changed since its quality index was built, updating it.")
+                    index = modules.data.quality.build_index(country, size, resizing)
+            
+            if index is None:
+                cloudy = modules.data.quality.legacy_list(country, "cloudy")
+                grayscale = modules.data.quality.legacy_list(country, "grayscale")
+                filenames = np.array(sorted(cloudy | grayscale), dtype=object)
+                index = pd.DataFrame({
+                    "filename": filenames,
+                    "cloudy": np.isin(filenames, list(cloudy)),
+                    "grayscale": np.isin(filenames, list(grayscale)),
+                    "corrupt": np.zeros(len(filenames), dtype=bool),
+                })
+            self._quality[country] = index
+        return self._quality[country]
 
     def class_weight(self, country):
         class_weight = None
@@ -69,87 +164,129 @@ class DataManager:
         df = dataframe[dataframe["class"] == cls]
         return df.sample(n=n, replace=False, random_state=self.config["seed"])
             
-    def generate_kenya(self):
-        
-        # get input directory
-        directory = f"{modules.data.util.root()}/kenya/{self.config['image_size']}/{self.config['resizing']}"
+    def flow_dataframe(self, country):
+        """
+        filename/class/index/id dataframe of every usable image of a country,
+        after quality filtering and before sampling.
+        """
+        dataframe = self._flow_dataframe(country)
         
-        # format dataframe for ImageDataGenerator.flow_from_dataframe
-        dataframe = self._format_dataframe_for_flow("kenya")
-        
-        if self.config['remove_clouds']:
-            cloud_directory = f"{modules.data.util.root()}/kenya/cloudy.txt"
-            cloud_filenames = pd.read_csv(cloud_directory, sep=" ", header=None)
-            cloud_filenames.columns = ["filename"]
-            
-            cloud_filenames["filename"] = cloud_filenames.filename.str.slice(16)
-            cloud_filenames["filename"] = cloud_filenames.filename.str.slice(0, -4) + ".jpg"
-
-            dataframe = dataframe[~dataframe['filename'].isin(cloud_filenames.filename)]
+        if self.config['remove_clouds'] or self.config.get('remove_grayscale', False):
+            dataframe = self.filter_quality(country, dataframe)
             
             print("Declouded dataframe length: " + str(len(dataframe.index)))
         
+        return dataframe
+    
+    def filename_index(self, country):
+        """
+        Shapefile record ("index") of every image of a country, as a Series
+        indexed by image filename ({index}_{id}.jpg). Built once, so
+        filenames are mapped to rows with one join instead of being parsed.
+        """
+        if country not in self._filename_index:
+            self._setup(country)
+            dataframe = self._flow_dataframe(country)
+            self._filename_index[country] = pd.Series(
+                dataframe["index"].values, index=pd.Index(dataframe["filename"].values, name="filename"), name="index"
+            )
+        return self._filename_index[country]
+    
+    def _flow_dataframe(self, country):
+        # flow_dataframe before quality filtering
+        if country == "kenya":
+            # format dataframe for ImageDataGenerator.flow_from_dataframe
+            dataframe = self._format_dataframe_for_flow("kenya")
+        elif country == "peru":
+            directory = self._directory(country)
+            
+            # the merged geodata and shapefile frame is built once by _setup
+            self._setup(country)
+            dataframe = self._format_dataframe_for_flow("peru")
+            dir_names = os.listdir(directory)
+            dataframe['filename'] = dataframe['filename'].str.split('_', n = 1, expand = True)[1]
+            dir_names = pd.DataFrame(dir_names)[0].str.split('_', n=1, expand=True).drop_duplicates(1, keep='last')
+            dir_names = dir_names.rename(columns={0: "prefix", 1: "filename"})
+            dataframe = pd.merge(dataframe, dir_names, on='filename')
+            dataframe['filename'] = dataframe['prefix'] + '_' + dataframe['filename']
+            dataframe = dataframe.drop(columns='prefix')
+        else:
+            raise ValueError("Country must be either \'kenya\' or \'peru\'.")
+        
+        return dataframe
+    
+    def labels(self, country, dataframe):
+        # class_enum value of every row of a flow dataframe
+        if country == "kenya":
+            return dataframe["class"].astype(int).values
+        return dataframe["class"].map(self.config["class_enum"]).values
+    
+    def sample_dataframe(self, country):
+        """
+        flow_dataframe of a country sampled as configured in config["sample"],
+        the dataframe the generators split into training and validation.
+        """
+        dataframe = self.flow_dataframe(country)
+        
         # sample the data
-        if self.config["sample"]:                    
+        if self.config["sample"]:
             if not self.config["sample"]["balanced"]:
                 dataframe = dataframe.sample(n=self.config["sample"]["size"], replace=False, random_state=self.config["seed"])
             else:
-                labels = set()
-                for cls in self.config["class_enum"]:
-                    if self.config["class_enum"][cls] >= 0:
-                        labels.add(str(self.config["class_enum"][cls]))
+                if country == "kenya":
+                    labels = set()
+                    for cls in self.config["class_enum"]:
+                        if self.config["class_enum"][cls] >= 0:
+                            labels.add(str(self.config["class_enum"][cls]))
+                    n = self.config["sample"]["size"] // len(labels)
+                else:
+                    labels = self.config["class_enum"]
+                    n = self.config["sample"]["size"] // self.config["n_classes"]
                 dataframes_per_class = []
-                for label in labels:
-                    df = self.sample_class(dataframe, label, (self.config["sample"]["size"] // len(labels)))
+                for label in sorted(labels):
+                    df = self.sample_class(dataframe, label, n)
                     dataframes_per_class.append(df)
                 dataframe = pd.concat(dataframes_per_class)
                 
-                # shuffle the data
-                dataframe = dataframe.reindex(np.random.permutation(dataframe.index))        
+                # shuffle the data, seeded so a resumed run sees the same order
+                dataframe = dataframe.reindex(np.random.RandomState(self.config["seed"]).permutation(dataframe.index))
+        
+        return dataframe
+    
+    def generate_kenya(self, start_step=0):
+        
+        # get input directory
+        directory = self._directory("kenya")
+        
+        dataframe = self.sample_dataframe("kenya")
 
-        # define data preprocessing
-        preprocessing_function = None
-        if self.config["pretrained"]:
-            module = modules.models.pretrained_cnn_module(self.config["pretrained"]["type"])
-            preprocessing_function = getattr(module, "preprocess_input")
-        else:
-            raise NotImplementedError("Custom model and preprocessing pipeline not yet defined.")
-        datagen = None
+        preprocessing_function = self._preprocessing_function(self.config["use_grayscale"])
         
-        if self.config["use_grayscale"]:
-            def new_preprocess(x):
-                x = tf.image.rgb_to_grayscale(x)
-                return preprocessing_function(x)
-            # make image data generator for rgb
-            datagen = ImageDataGenerator(
-                preprocessing_function=new_preprocess,
-                validation_split=self.config["validation_split"],
+        dataframe_mask, directory_mask, mask_function = self._mask_sources("kenya", dataframe, self._use_tfdata())
+        
+        if self._use_tfdata():
+            train_generator = self._build_dataset(
+                dataframe, directory, preprocessing_function, "training", 
+                dataframe_mask=dataframe_mask, directory_mask=directory_mask, mask_function=mask_function,
+                start_step=start_step
             )
-            
-        else:
-            # make image data generator for rgb
-            datagen = ImageDataGenerator(
-                preprocessing_function=preprocessing_function,
-                validation_split=self.config["validation_split"],
+            val_generator = self._build_dataset(
+                dataframe, directory, preprocessing_function, "validation", 
+                dataframe_mask=dataframe_mask, directory_mask=directory_mask, mask_function=mask_function
             )
+            return train_generator, val_generator, dataframe
+        
+        # make image data generator for rgb
+        datagen = ImageDataGenerator(
+            preprocessing_function=preprocessing_function,
+            validation_split=self.config["validation_split"],
+        )
         
         if self.config["mask"] == 'none':
             train_generator = self._build_generator(datagen, dataframe, directory, "training")
             val_generator = self._build_generator(datagen, dataframe, directory, "validation")            
-        elif self.config["mask"] == "occlude" or self.config["mask"] == "overlay" or self.config["mask"] == "overlay_3":
+        elif dataframe_mask is not None:
             datagen_mask = ImageDataGenerator(validation_split=self.config["validation_split"])
-            dataframe_mask = pd.DataFrame(
-                list(map(
-                    lambda e: (f"{e[0]}_kenya_224x224_mask_20.png", e[2]), 
-                    zip(
-                        self.dataframes['kenya'].index,
-                        map(int, self.dataframes['kenya']["id"]),
-                        self.dataframes['kenya']["class"]
-                    )
-                )),
-                columns=["filename", "class"])
-            dataframe_mask = dataframe_mask.iloc[dataframe.index]
-            directory_mask = f"{modules.data.util.root()}/kenya/kenya_224x224_masks_20/"
 
             train_generator = self.multiple_generator(
                 datagen, datagen_mask, 
@@ -167,61 +304,19 @@ class DataManager:
         return train_generator, val_generator, dataframe
 
 
-    def generate_peru(self):
-        directory = f"{modules.data.util.root()}/peru/{self.config['image_size']}/{self.config['resizing']}"
-        country="peru"
-
-        geo = modules.data.load_geodata(country)
-        geo = geo.iloc[::2].reset_index()
-        geo['index'] = geo['index'] / 2
-        osm, sf = modules.data.load_shapefile(country)
-
-        self.shapefiles[country] = sf
-        self.dataframes[country] = pd.DataFrame.merge(geo, osm, on="index")
-        self.dataframes[country]['index'] = (self.dataframes[country]['index'] * 2).astype('int32')
-        self.dataframes[country] = self.dataframes[country].set_index(self.dataframes[country]['index'])
-        dataframe = self._format_dataframe_for_flow("peru")
-        dir_names = os.listdir(directory)
-        dataframe['filename'] = dataframe['filename'].str.split('_', n = 1, expand = True)[1]
-        dir_names = pd.DataFrame(dir_names)[0].str.split('_', n=1, expand=True).drop_duplicates(1, keep='last')
-        dir_names = dir_names.rename(columns={0: "prefix", 1: "filename"})
-        dataframe = pd.merge(dataframe, dir_names, on='filename')
-        dataframe['filename'] = dataframe['prefix'] + '_' + dataframe['filename']
-        dataframe = dataframe.drop(columns='prefix')
-        
-        if self.config['remove_clouds']:
-            cloud_directory = f"{modules.data.util.root()}/peru/cloudy.txt"
-            cloud_filenames = pd.read_csv(cloud_directory, sep=" ", header=None)
-            cloud_filenames.columns = ["filename"]
-            
-            cloud_filenames["filename"] = cloud_filenames.filename.str.slice(16)
-            cloud_filenames["filename"] = cloud_filenames.filename.str.slice(0, -4) + ".jpg"
-
-            dataframe = dataframe[~dataframe['filename'].isin(cloud_filenames.filename)]
-            
-            print("Declouded dataframe length: " + str(len(dataframe.index)))
-            
-        # sample the data
-        if self.config["sample"]:
-            if not self.config["sample"]["balanced"]:
-                dataframe = dataframe.sample(n=self.config["sample"]["size"], replace=False, random_state=self.config["seed"])
-            else:
-                dataframes_per_class = []
-                for cls in self.config["class_enum"]:
-                    df = self.sample_class(dataframe, cls, (self.config["sample"]["size"] // self.config["n_classes"]))
-                    dataframes_per_class.append(df)
-                dataframe = pd.concat(dataframes_per_class)
-                
-                # shuffle the data
-                dataframe = dataframe.reindex(np.random.permutation(dataframe.index))        
+    def generate_peru(self, start_step=0):
+        directory = self._directory("peru")
+        
+        dataframe = self.sample_dataframe("peru")
 
-        # define data preprocessing
-        preprocessing_function = None
-        if self.config["pretrained"]:
-            module = modules.models.pretrained_cnn_module(self.config["pretrained"]["type"])
-            preprocessing_function = getattr(module, "preprocess_input")
-        else:
-            raise NotImplementedError("Custom model and preprocessing pipeline not yet defined.")
+        preprocessing_function = self._preprocessing_function()
+        
+        if self._use_tfdata():
+            if self.config["mask"] != 'none':
+                raise NotImplementedError("Masking not implemented for Peru.")
+            train_generator = self._build_dataset(dataframe, directory, preprocessing_function, "training", start_step=start_step)
+            val_generator = self._build_dataset(dataframe, directory, preprocessing_function, "validation")
+            return train_generator, val_generator, dataframe
         
         # make image data generator for rgb
         datagen = ImageDataGenerator(
@@ -236,6 +331,80 @@ class DataManager:
             raise NotImplementedError("Masking not implemented for Peru.")
                
         return train_generator, val_generator, dataframe
+    
+    def generate_inference(self, country, dataframe=None, start=0):
+        """
+        One ordered pass over every image of a country (no sampling and no
+        validation split) through the tf.data pipeline, whatever the
+        configured pipeline, optionally starting at row start of the flow
+        dataframe. Returns the dataset of (image, one-hot label) batches and
+        the flow dataframe rows in the same order.
+        """
+        directory = self._directory(country)
+        
+        if dataframe is None:
+            dataframe = self.flow_dataframe(country)
+        dataframe = dataframe.iloc[start:]
+        
+        dataframe_mask, directory_mask, mask_function = None, None, None
+        if country == "kenya":
+            preprocessing_function = self._preprocessing_function(self.config["use_grayscale"])
+            dataframe_mask, directory_mask, mask_function = self._mask_sources(country, dataframe, True)
+        else:
+            if self.config["mask"] != 'none':
+                raise NotImplementedError("Masking not implemented for Peru.")
+            preprocessing_function = self._preprocessing_function()
+        
+        dataset = self._build_dataset(
+            dataframe, directory, preprocessing_function, None, 
+            dataframe_mask=dataframe_mask, directory_mask=directory_mask, mask_function=mask_function
+        )
+        return dataset, dataframe
+    
+    def _directory(self, country):
+        return f"{modules.data.util.root()}/{country}/{self.config['image_size']}/{self.config['resizing']}"
+    
+    def _preprocessing_function(self, grayscale=False):
+        # define data preprocessing
+        preprocessing_function = None
+        if self.config["pretrained"]:
+            module = modules.models.pretrained_cnn_module(self.config["pretrained"]["type"])
+            preprocessing_function = getattr(module, "preprocess_input")
+        else:
+            raise NotImplementedError("Custom model and preprocessing pipeline not yet defined.")
+        
+        if grayscale:
+            rgb_preprocessing_function = preprocessing_function
+            def new_preprocess(x):
+                x = tf.image.rgb_to_grayscale(x)
+                return rgb_preprocessing_function(x)
+            preprocessing_function = new_preprocess
+        
+        return preprocessing_function
+    
+    def _mask_sources(self, country, dataframe, tfdata):
+        # (dataframe_mask, directory_mask, mask_function) aligned with the rows of dataframe
+        dataframe_mask = None
+        directory_mask = None
+        mask_function = None
+        if self.config["mask"] == "occlude" or self.config["mask"] == "overlay" or self.config["mask"] == "overlay_3":
+            threshold = self.config.get("mask_threshold", 20)
+            
+            if self.config.get("mask_source", "rendered") == "shapefile":
+                if not tfdata or self.config.get("pipeline") == "shards":
+                    raise ValueError("Masks rasterized from the shapefile require \'pipeline: tfdata\'.")
+                dataframe_mask = pd.DataFrame({"index": self.dataframes[country].index[dataframe.index]})
+                mask_function = functools.partial(self.road_masks, country)
+            else:
+                suffix = modules.data.masks.mask_filename("", country, self.config["image_size"], threshold)
+                dataframe_mask = pd.DataFrame({
+                    "filename": self.dataframes[country].index.astype(str) + suffix,
+                    "class": self.dataframes[country]["class"].values,
+                })
+                dataframe_mask = dataframe_mask.iloc[dataframe.index]
+                directory_mask = modules.data.masks.mask_directory(country, self.config["image_size"], threshold)
+        
+        return dataframe_mask, directory_mask, mask_function
 
         
     def multiple_generator(self, datagen1, datagen2, dataframe1, dataframe2, directory1, directory2, subset):
@@ -245,15 +414,94 @@ class DataManager:
         while True:
             x1, y1 = generator1.next()
             x2, y2 = generator2.next()
+            # single-channel, flipped view of the mask batch; both batches are already float32
+            mask = x2[:, ::-1, :, :1]
             if self.config["mask"] == "occlude":
-                if not self.config['mask_inverted']:
-                    yield (x1 * np.flip(x2, axis=1)).astype(np.float32), y1
-                else:
-                    yield (x1 * (1 - np.flip(x2, axis=1))).astype(np.float32), y1
+                if self.config['mask_inverted']:
+                    mask = 1 - mask
+                np.multiply(x1, mask, out=x1)
+                yield x1, y1
             elif self.config["mask"] == "overlay":
-                yield np.concatenate((x1, np.expand_dims(np.flip(x2, axis=1)[:, :, :, 0], axis=3)), axis=3), y1
+                yield np.concatenate((x1, mask), axis=3), y1
             elif self.config["mask"] == "overlay_3":
-                yield np.concatenate((x1[:, :, :, :-1], np.expand_dims(np.flip(x2, axis=1)[:, :, :, 0], axis=3)), axis=3), y1
+                x1[:, :, :, -1:] = mask
+                yield x1, y1
+                
+    def _use_tfdata(self):
+        pipeline = self.config.get("pipeline", "keras")
+        if pipeline not in ("keras", "tfdata", "shards"):
+            raise ValueError("Config \'pipeline\' must be one of \'keras\', \'tfdata\' or \'shards\'.")
+        if pipeline == "keras" and self.config.get("preprocessing", "pipeline") == "model":
+            raise ValueError("Config \'preprocessing: model\' requires \'pipeline: tfdata\' or \'shards\'.")
+        return pipeline != "keras"
+    
+    def _load_shards(self, directory):
+        # shards are packed next to the chip directory by modules.data.processing.pack_shards
+        if directory not in self._shards:
+            self._shards[directory] = modules.data.pipeline.Shards(f"{directory}_shards")
+        return self._shards[directory]
+    
+    def _build_dataset(self, dataframe, directory, preprocessing_function, subset, dataframe_mask=None, directory_mask=None, mask_function=None, start_step=0):
+        pipeline = modules.data.pipeline
+        
+        indices = pipeline.class_indices(dataframe)
+        dataframe = pipeline.split(dataframe, self.config["validation_split"], subset)
+        
+        paths = (directory + "/" + dataframe["filename"]).values
+        labels = dataframe["class"].map(indices).values
+        
+        mask_paths = None
+        if dataframe_mask is not None:
+            dataframe_mask = pipeline.split(dataframe_mask, self.config["validation_split"], subset)
+            if mask_function is not None:
+                mask_paths = dataframe_mask["index"].values.astype(np.int64)
+            else:
+                mask_paths = (directory_mask + "/" + dataframe_mask["filename"]).values
+        
+        shards = None
+        if self.config.get("pipeline", "keras") == "shards":
+            shards = self._load_shards(directory.rstrip("/"))
+            if self.config["mask"] != "none" and shards.mask_threshold != self.config.get("mask_threshold", 20):
+                raise ValueError(
+                    f"The shards in {shards.directory} were packed with mask_threshold {shards.mask_threshold}, "
+                    f"not {self.config.get('mask_threshold', 20)}, rerun pack_shards."
+                )
+            paths = shards.positions(dataframe["filename"].values)
+            mask_paths = None
+        
+        return pipeline.build_dataset(
+            paths, labels, len(indices), self.config,
+            preprocessing_function=preprocessing_function,
+            subset=subset,
+            mask_paths=mask_paths,
+            mask_function=mask_function,
+            shards=shards,
+            start_step=start_step
+        )
+    
+    def road_masks(self, country, indices):
+        """
+        Road masks for a batch of dataframe indices as a (n, size, size, 1)
+        uint8 array, rasterized from the shapefile with an LRU cache.
+        """
+        size = self.config["image_size"]
+        masks = np.empty((len(indices), size, size, 1), dtype=np.uint8)
+        for i, index in enumerate(indices):
+            masks[i, :, :, 0] = self._road_mask(country, int(index))
+        return masks
+    
+    def _rasterize_road_mask(self, country, index):
+        # the shapefile reader seeks on shared file handles
+        with self._shapefile_lock:
+            points = self.shapefiles[country].shape(index).points
+        row = self.dataframes[country].loc[index]
+        return modules.data.masks.rasterize(
+            points, row["minlat"], row["maxlat"], row["minlon"], row["maxlon"],
+            threshold=self.config.get("mask_threshold", 20),
+            size=self.config["image_size"],
+            resizing=self.config["resizing"]
+        )
+    
     def _build_generator(self, datagen, dataframe, directory, subset):
         to_shuffle = True
         if subset == "validation":
@@ -272,31 +520,21 @@ class DataManager:
         )
             
     def _format_dataframe_for_flow(self, country, suffix=None):
+        dataframe = self.dataframes[country]
+        
         if country == 'kenya':
-            return pd.DataFrame(
-                list(map(
-                    lambda e: (self._format_filename(e[0], e[1], suffix=suffix), e[2]), 
-                    zip(
-                        self.dataframes[country].index, 
-                        map(int, self.dataframes[country]["id"]),
-                        map(str, self.dataframes[country]["label"]),
-                    )
-                )),
-                columns=["filename", "class"]
-            )
+            classes = dataframe["label"].astype(str).values
+        elif country == 'peru':
+            classes = dataframe["class"].values
+        else:
+            return None
         
-        if country == 'peru':
-            return pd.DataFrame(
-                list(map(
-                    lambda e: (self._format_filename(e[0], e[1], suffix=suffix), e[2]), 
-                    zip(
-                        self.dataframes[country].index, 
-                        map(int, self.dataframes[country]["id"]),
-                        self.dataframes[country]["class"]
-                    )
-                )),
-                columns=["filename", "class"]
-            )
+        return pd.DataFrame({
+            "filename": self._format_filenames(dataframe.index, dataframe["id"], suffix=suffix).values,
+            "class": classes,
+            "index": dataframe.index.values,
+            "id": dataframe["id"].values.astype(np.int64),
+        })
             
     def _format_filename(self, id1, id2, suffix=None, ext="jpg"):
         if suffix is None:
@@ -304,6 +542,15 @@ class DataManager:
         else:
             return f"{id1}_{id2}_{suffix}.{ext}"
     
+    def _format_filenames(self, id1, id2, suffix=None, ext="jpg"):
+        # vectorized _format_filename over columns, ids are truncated to int like int(id)
+        id1 = pd.Series(np.asarray(id1)).astype(str)
+        id2 = pd.Series(np.asarray(id2).astype(np.int64)).astype(str)
+        if suffix is None:
+            return id1 + "_" + id2 + f".{ext}"
+        else:
+            return id1 + "_" + id2 + f"_{suffix}.{ext}"
+    
     def _extract_filenames(self, directory):
         filenames = map(lambda x: x.strip(), os.listdir(directory))
         filenames = set(filenames)
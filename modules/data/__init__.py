@@ -2,4 +2,7 @@ from modules.data.data import *
 from modules.data import util
 from modules.data import processing
 from modules.data import visualize
+from modules.data import pipeline
+from modules.data import masks
+from modules.data import quality
 from modules.data.DataManager import DataManager
\ No newline at end of file
@@ -32,22 +32,45 @@ def _load_shapefile(country, encoding="iso-8859-1"):
     sf.encoding = encoding
     return sf
 
+class LazyShapes:
+    """
+    Polyline geometry of a country's roads, fetched by record index.
+
+    The .shp/.shx pair is only opened on the first shape() call and can be
+    released with close(); the .dbf attributes are never touched.
+    """
+    
+    def __init__(self, country):
+        util.validate_country(country)
+        self.path = os.path.join(util.root(), country, f"{country}_roads")
+        self._reader = None
+    
+    def shape(self, i):
+        if self._reader is None:
+            self._reader = shapefile.Reader(shp=open(f"{self.path}.shp", "rb"), shx=open(f"{self.path}.shx", "rb"))
+        return self._reader.shape(i)
+    
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+def load_shapes(country):
+    return LazyShapes(country)
+
 def load_shapefile(country):
     util.validate_country(country)
     sf = _load_shapefile(country, encoding="iso-8859-1")
-    table = []
-    columns = ("index", "highway", "class", "name")
-    for i, sr in enumerate(sf.shapeRecords()):
-        if sr.record.highway in CLASSMAP:
-            row = (
-                i, 
-                sr.record.highway, 
-                CLASSMAP[sr.record.highway], 
-                sr.record.name
-            )
-            table.append(row)
-    df = pandas.DataFrame.from_records(table, index="index", columns=columns)
-    return df, sf
+    # records only: the .dbf columns are read in bulk without decoding any geometry
+    try:
+        records = pandas.DataFrame.from_records(sf.records(fields=["highway", "name"]), columns=["highway", "name"])
+    finally:
+        sf.close()
+    records["class"] = records["highway"].map(CLASSMAP)
+    df = records[records["class"].notna()]
+    df.index.name = "index"
+    df = df[["highway", "class", "name"]]
+    return df, load_shapes(country)
     
 # .csv road and image bounding box data handling
 
@@ -0,0 +1,110 @@
+import os
+import time
+import multiprocessing
+
+import cv2
+import numpy as np
+import skimage.draw
+
+from scipy import ndimage
+
+from modules.data import util
+from modules.data import data
+
+ORIG_DIM = 1000
+
+# road mask rasterization from the shapefile polylines
+
+def mask_directory(country, size=224, threshold=20, resizing="cropped"):
+    if resizing == "cropped":
+        return os.path.join(util.root(), country, f"{country}_{size}x{size}_masks_{threshold}")
+    return os.path.join(util.root(), country, f"{country}_{size}x{size}_masks_{resizing}_{threshold}")
+
+def mask_filename(index, country, size=224, threshold=20, resizing="cropped"):
+    if resizing == "cropped":
+        return f"{index}_{country}_{size}x{size}_mask_{threshold}.png"
+    return f"{index}_{country}_{size}x{size}_mask_{resizing}_{threshold}.png"
+
+def rasterize(points, minlat, maxlat, minlon, maxlon, threshold=20, size=224, resizing="cropped", orig_dim=ORIG_DIM):
+    """
+    Rasterize a road polyline into a (size, size) uint8 mask of 0s and 1s.
+
+    Every pixel within threshold pixels (Euclidean) of the polyline, drawn
+    on the orig_dim x orig_dim grid spanned by the bounding box, is set.
+    Rows follow latitude, so the mask is upside down with respect to the
+    image chip. resizing is either "cropped" (central window) or "scaled"
+    (the whole grid resized to size).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    lon, lat = points[:, 0], points[:, 1]
+    inside = (minlat < lat) & (lat < maxlat) & (minlon < lon) & (lon < maxlon)
+
+    cols = np.round(orig_dim * (lon[inside] - minlon) / (maxlon - minlon)).astype(int)
+    rows = np.round(orig_dim * (lat[inside] - minlat) / (maxlat - minlat)).astype(int)
+
+    if resizing == "cropped":
+        low, high = orig_dim // 2 - size // 2, orig_dim // 2 + size // 2
+    elif resizing == "scaled":
+        low, high = 0, orig_dim
+    else:
+        raise ValueError("Parameter \'resizing\' must be one of either \'cropped\' or \'scaled\'.")
+
+    # only line pixels within threshold of the output window can reach it
+    margin = int(np.ceil(threshold)) + 1
+    offset = low - margin
+    dim = high - low + 2 * margin
+
+    canvas = np.zeros((dim, dim), dtype=bool)
+    for i in range(len(rows) - 1):
+        rr, cc = skimage.draw.line(rows[i], cols[i], rows[i + 1], cols[i + 1])
+        rr, cc = rr - offset, cc - offset
+        keep = (rr >= 0) & (rr < dim) & (cc >= 0) & (cc < dim)
+        canvas[rr[keep], cc[keep]] = True
+
+    if not canvas.any():
+        return np.zeros((size, size), dtype=np.uint8)
+
+    mask = ndimage.distance_transform_edt(~canvas) <= threshold
+    mask = mask[margin:margin + high - low, margin:margin + high - low]
+
+    if resizing == "scaled":
+        mask = cv2.resize(mask.astype(np.float32), (size, size), interpolation=cv2.INTER_AREA) >= 0.5
+
+    return mask.astype(np.uint8)
+
+_shapefile = None
+
+def _open_shapefile(country):
+    global _shapefile
+    _shapefile = data.load_shapes(country)
+
+def _render(args):
+    index, bbox, path, threshold, size, resizing = args
+    mask = rasterize(_shapefile.shape(index).points, *bbox, threshold=threshold, size=size, resizing=resizing)
+    cv2.imwrite(path, mask)
+
+def render_masks(country, dataframe, threshold=20, size=224, resizing="cropped", workers=None):
+    """
+    Write the road mask of every row of dataframe (a DataManager dataframe,
+    indexed by shapefile record with minlat/maxlat/minlon/maxlon columns)
+    to mask_directory(...) using a pool of workers (all cores if None).
+    """
+    util.validate_country(country)
+
+    o_path = mask_directory(country, size, threshold, resizing)
+    if not os.path.exists(o_path):
+        os.makedirs(o_path)
+
+    bboxes = dataframe[["minlat", "maxlat", "minlon", "maxlon"]].values.astype(np.float64)
+    jobs = [
+        (int(index), tuple(bbox), os.path.join(o_path, mask_filename(index, country, size, threshold, resizing)), threshold, size, resizing)
+        for index, bbox in zip(dataframe.index, bboxes)
+    ]
+
+    start = time.time()
+    with multiprocessing.Pool(workers, initializer=_open_shapefile, initargs=(country,)) as pool:
+        for i, _ in enumerate(pool.imap_unordered(_render, jobs, chunksize=64)):
+            if i % 1000 == 0:
+                print(f"Rendered {i}/{len(jobs)} masks, {i / max(time.time() - start, 1e-9):.1f} masks/s.")
+
+    print(f"Rendered {len(jobs)} masks to {o_path} in {time.time() - start:.1f}s.")
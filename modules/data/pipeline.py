@@ -0,0 +1,211 @@
+import os
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+# tf.data input pipeline, a drop-in replacement for ImageDataGenerator.flow_from_dataframe
+
+def class_indices(dataframe, column="class"):
+    # flow_from_dataframe sorts the class names of the full dataframe before splitting
+    classes = sorted(dataframe[column].unique())
+    return dict(zip(classes, range(len(classes))))
+
+def split(dataframe, validation_split, subset):
+    # same slicing as ImageDataGenerator: the first validation_split fraction is validation
+    n = len(dataframe)
+    if subset is None:
+        return dataframe
+    elif subset == "validation":
+        start, stop = 0, validation_split
+    elif subset == "training":
+        start, stop = validation_split, 1
+    else:
+        raise ValueError("Parameter \'subset\' must be one of either \'training\' or \'validation\'.")
+    return dataframe.iloc[int(start * n):int(stop * n)]
+
+def decode_jpeg(path, image_size):
+    image = tf.io.decode_jpeg(tf.io.read_file(path), channels=3, dct_method="INTEGER_ACCURATE")
+    image = tf.image.resize(image, (image_size, image_size), method="nearest")
+    image.set_shape((image_size, image_size, 3))
+    return image
+
+def decode_mask(path, image_size):
+    mask = tf.io.decode_png(tf.io.read_file(path), channels=1)
+    mask = tf.image.resize(mask, (image_size, image_size), method="nearest")
+    mask.set_shape((image_size, image_size, 1))
+    return mask
+
+def apply_mask(images, masks, mode, inverted=False):
+    """
+    Fuse a batch of road masks into a batch of preprocessed images.
+
+    The rendered masks are stored upside down with respect to the chips,
+    so they are flipped along the row axis first.
+        => occlude: images * mask (or * (1 - mask) when inverted)
+        => overlay: mask appended as a fourth channel
+        => overlay_3: mask replaces the last channel
+    """
+    masks = tf.reverse(tf.cast(masks, images.dtype), axis=[1])
+    if mode == "occlude":
+        if inverted:
+            masks = 1 - masks
+        return images * masks
+    elif mode == "overlay":
+        return tf.concat([images, masks], axis=3)
+    elif mode == "overlay_3":
+        return tf.concat([images[:, :, :, :-1], masks], axis=3)
+    else:
+        raise ValueError("Parameter \'mode\' must be one of \'occlude\', \'overlay\' or \'overlay_3\'.")
+
+class Shards:
+    """
+    Memory-mapped view over the uint8 shards written by
+    modules.data.processing.pack_shards.
+    """
+    
+    def __init__(self, directory):
+        if not os.path.exists(os.path.join(directory, "filenames.npy")):
+            raise ValueError(f"No shards in {directory}, run modules.data.processing.pack_shards first.")
+        
+        self.directory = directory
+        self.filenames = np.load(os.path.join(directory, "filenames.npy"))
+        self.shard_size = int(np.load(os.path.join(directory, "shard_size.npy")))
+        
+        n_shards = (len(self.filenames) + self.shard_size - 1) // self.shard_size
+        self.images = [np.load(os.path.join(directory, f"images_{s:05d}.npy"), mmap_mode="r") for s in range(n_shards)]
+        self.masks = None
+        if os.path.exists(os.path.join(directory, "masks_00000.npy")):
+            self.masks = [np.load(os.path.join(directory, f"masks_{s:05d}.npy"), mmap_mode="r") for s in range(n_shards)]
+        
+        # recorded by pack_shards with every shard, None if packed without masks or before it was
+        self.mask_threshold = None
+        if os.path.exists(os.path.join(directory, "shard_00000.npz")):
+            with np.load(os.path.join(directory, "shard_00000.npz")) as shard:
+                threshold = str(shard["mask_threshold"])
+            self.mask_threshold = None if threshold == "None" else int(threshold)
+        
+        self._positions = pd.Series(np.arange(len(self.filenames)), index=self.filenames)
+    
+    def positions(self, filenames):
+        positions = self._positions.reindex(filenames).values
+        if np.isnan(positions).any():
+            raise ValueError(f"Some files are missing from the shards in {self.directory}, rerun pack_shards.")
+        return positions.astype(np.int64)
+    
+    def _gather(self, arrays, positions):
+        # read shard by shard in ascending order, then restore the batch order
+        order = np.argsort(positions)
+        positions = positions[order]
+        out = np.empty((len(positions),) + arrays[0].shape[1:], dtype=np.uint8)
+        shards = positions // self.shard_size
+        for s in np.unique(shards):
+            batch = shards == s
+            out[order[batch]] = arrays[s][positions[batch] % self.shard_size]
+        return out
+    
+    def read_images(self, positions):
+        return self._gather(self.images, positions)
+    
+    def read_masks(self, positions):
+        if self.masks is None:
+            raise ValueError(f"The shards in {self.directory} were packed without masks.")
+        return self._gather(self.masks, positions)[..., None]
+
+def build_dataset(paths, labels, n_classes, config, preprocessing_function=None, subset="training", mask_paths=None, mask_function=None, shards=None, start_step=0):
+    """
+    Stream (image, one-hot label) batches from a list of file paths.
+
+    Decoding runs with num_parallel_calls, preprocessing runs once per
+    batch and the next batches are prefetched while the model trains.
+    The training subset is reshuffled every epoch and repeats forever,
+    like the Keras iterators; the validation subset (or subset=None, for
+    inference) is a single ordered pass. When training is distributed
+    (config replica_batch_size, see modules.run.Runner.init_strategy) the
+    validation pass drops its final partial batch. start_step resumes the
+    training stream after that many batches, skipping file names rather
+    than decoded images.
+
+    If mask_paths is given, each image is read together with its mask and
+    the two are fused per batch according to config["mask"]. If mask_function
+    is also given, mask_paths are keys it maps to a uint8 (n, size, size, 1)
+    batch of masks instead of files.
+
+    If shards is given, paths are positions into the packed Shards and whole
+    batches (and masks, when config["mask"] is set) are read from them.
+    
+    With config preprocessing: model, preprocessing_function is not applied
+    and the batches stay uint8, with the mask as a fourth channel, for the
+    Preprocessing layer of modules.models.
+    """
+    image_size = config["image_size"]
+
+    use_masks = mask_paths is not None or (shards is not None and config["mask"] != "none")
+    in_model = config.get("preprocessing", "pipeline") == "model"
+    # a final partial validation batch cannot be split across the replicas of a tf.distribute strategy
+    drop_remainder = subset == "validation" and config["batch_size"] != config.get("replica_batch_size", config["batch_size"])
+
+    if mask_paths is None:
+        dataset = tf.data.Dataset.from_tensor_slices((np.asarray(paths), np.asarray(labels, dtype=np.int32)))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(
+            ((np.asarray(paths), np.asarray(mask_paths)), np.asarray(labels, dtype=np.int32))
+        )
+
+    if subset == "training":
+        dataset = dataset.shuffle(len(paths), seed=config["seed"], reshuffle_each_iteration=True)
+        dataset = dataset.repeat()
+        dataset = dataset.skip(start_step * config["batch_size"])
+
+    def load(path, label):
+        if mask_paths is None:
+            return decode_jpeg(path, image_size), tf.one_hot(label, n_classes)
+        image_path, mask_path = path
+        if mask_function is not None:
+            return (decode_jpeg(image_path, image_size), mask_path), tf.one_hot(label, n_classes)
+        return (decode_jpeg(image_path, image_size), decode_mask(mask_path, image_size)), tf.one_hot(label, n_classes)
+
+    def render(images, labels):
+        images, keys = images
+        masks = tf.numpy_function(mask_function, [keys], tf.uint8)
+        masks.set_shape((None, image_size, image_size, 1))
+        return (images, masks), labels
+
+    def read(positions, labels):
+        images = tf.numpy_function(shards.read_images, [positions], tf.uint8)
+        images.set_shape((None, image_size, image_size, 3))
+        if not use_masks:
+            return images, tf.one_hot(labels, n_classes)
+        masks = tf.numpy_function(shards.read_masks, [positions], tf.uint8)
+        masks.set_shape((None, image_size, image_size, 1))
+        return (images, masks), tf.one_hot(labels, n_classes)
+
+    def preprocess(images, labels):
+        masks = None
+        if use_masks:
+            images, masks = images
+        images = tf.cast(images, tf.float32)
+        if preprocessing_function is not None:
+            images = preprocessing_function(images)
+        if masks is not None:
+            images = apply_mask(images, masks, config["mask"], config["mask_inverted"])
+        return images, labels
+
+    def pack(images, labels):
+        if use_masks:
+            images, masks = images
+            images = tf.concat([images, tf.cast(masks, tf.uint8)], axis=3)
+        return images, labels
+
+    if shards is None:
+        dataset = dataset.map(load, num_parallel_calls=AUTOTUNE)
+        dataset = dataset.batch(config["batch_size"], drop_remainder=drop_remainder)
+        if mask_function is not None:
+            dataset = dataset.map(render, num_parallel_calls=AUTOTUNE)
+    else:
+        dataset = dataset.batch(config["batch_size"], drop_remainder=drop_remainder)
+        dataset = dataset.map(read, num_parallel_calls=AUTOTUNE)
+    dataset = dataset.map(pack if in_model else preprocess, num_parallel_calls=AUTOTUNE)
+
+    return dataset.prefetch(AUTOTUNE)
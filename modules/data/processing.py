@@ -1,75 +1,181 @@
 import cv2
 import numpy as np
 import os, sys
+import time
+import multiprocessing
 
 from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-from modules.data import util
+from modules.data import util, masks
                 
-def downscale(country, D, subsampling=0, quality=90):
+def _resample(args):
+    i_file, o_file, mode, D, subsampling, quality = args
+    
+    # up to date outputs from a previous (partial) run are kept
+    if os.path.exists(o_file) and os.path.getmtime(o_file) >= os.path.getmtime(i_file):
+        return None, False
+    
+    try:
+        im = Image.open(i_file)
+        
+        if mode == "scaled":
+            im = im.resize((D, D)).convert("RGB")
+        else:
+            greater = 1000 // 2 + D // 2
+            smaller = 1000 // 2 - D // 2
+            im = im.crop((smaller, smaller, greater, greater)).convert("RGB")
+        
+        util.atomic_save(o_file, lambda tmp_file: im.save(tmp_file, "JPEG", subsampling=subsampling, quality=quality))
+    except:
+        return os.path.basename(i_file), False
+    
+    return None, True
+
+def _process(country, D, mode, subsampling=0, quality=90, workers=None):
 
     i_path = os.path.join(util.root(), country, f"{country}_1000x1000_images")
-    o_path = os.path.join(util.root(), country, f"{D}", "scaled")
+    o_path = os.path.join(util.root(), country, f"{D}", mode)
     
     if not os.path.exists(o_path):
         os.makedirs(o_path)
     
-    errors = []
-    
-    for i, fname in enumerate(os.listdir(i_path)):
-        if i % 1000 == 0:
-            print(f"Processed {i} file descriptors.")
+    jobs = []
+    for fname in os.listdir(i_path):
         if os.path.isfile(os.path.join(i_path, fname)):
-            try:
-                im = Image.open(os.path.join(i_path, fname))
-            except:
-                errors.append(fname)
-                continue
-
             head, _ = os.path.splitext(fname)
             head = head.split("_")[-1]
-            
-            im = im.resize((D, D)).convert("RGB")
+            jobs.append((os.path.join(i_path, fname), os.path.join(o_path, f"{head}.jpg"), mode, D, subsampling, quality))
+    
+    errors = []
+    written = 0
+    start = time.time()
+    
+    pool = None
+    if workers is None or workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_resample, jobs, chunksize=64)
+    else:
+        results = map(_resample, jobs)
+    
+    try:
+        for i, (error, wrote) in enumerate(results):
+            if error is not None:
+                errors.append(error)
+            written += wrote
+            if i % 1000 == 0:
+                elapsed = time.time() - start
+                print(f"Processed {i}/{len(jobs)} file descriptors, {written / max(elapsed, 1e-9):.1f} images/s.")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    elapsed = time.time() - start
+    print(f"Wrote {written} images ({len(jobs) - written - len(errors)} up to date, {len(errors)} errors) "
+          f"in {elapsed:.1f}s, {written / max(elapsed, 1e-9):.1f} images/s.")
+    
+    util.atomic_save(os.path.join(o_path, "errors.txt"), "".join(f"{e}\n" for e in errors))
 
-            im.save(os.path.join(o_path, f"{head}.jpg"), "JPEG", subsampling=subsampling, quality=quality)
-            
-    with open(os.path.join(o_path, "errors.txt"), "w") as o_err:
-        for e in errors:
-            o_err.write(f"{e}\n")
+def downscale(country, D, subsampling=0, quality=90, workers=None):
+    """
+    Resize every 1000x1000 image to D x D into data/<country>/<D>/scaled
+    using a pool of workers (all cores if None). Outputs that are newer
+    than their source are skipped, so interrupted runs resume.
+    """
+    _process(country, D, "scaled", subsampling=subsampling, quality=quality, workers=workers)
 
 
-def downcrop(country, D, subsampling=0, quality=90):
+def downcrop(country, D, subsampling=0, quality=90, workers=None):
+    """
+    Crop the central D x D window of every 1000x1000 image into
+    data/<country>/<D>/cropped; see downscale.
+    """
+    _process(country, D, "cropped", subsampling=subsampling, quality=quality, workers=workers)
 
-    i_path = os.path.join(util.root(), country, f"{country}_1000x1000_images")
-    o_path = os.path.join(util.root(), country, f"{D}", "cropped")
+
+def _shard_complete(o_path, s, shard, mask_threshold):
+    # a shard is complete once its shard_XXXXX.npz, written after its images and masks, lists the same chips
+    path = os.path.join(o_path, f"shard_{s:05d}.npz")
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as done:
+        return list(done["filenames"]) == list(shard) and str(done["mask_threshold"]) == str(mask_threshold)
+
+def pack_shards(country, D, resizing="cropped", shard_size=4096, mask_threshold=None, labels=None):
+    """
+    Pack the decoded D x D chips of data/<country>/<D>/<resizing> into
+    fixed-size uint8 .npy shards under data/<country>/<D>/<resizing>_shards.
+
+        => filenames.npy: chip filenames, in shard order
+        => images_XXXXX.npy: (shard_size, D, D, 3) uint8 chips
+        => masks_XXXXX.npy: (shard_size, D, D) uint8 road masks (if mask_threshold)
+        => classes.npy: class per chip (if labels, a filename -> class mapping)
+
+    Shards that are already complete are skipped, so an interrupted run
+    resumes where it stopped. The shards are read back memory-mapped by
+    modules.data.pipeline.Shards.
+    """
+
+    i_path = os.path.join(util.root(), country, f"{D}", resizing)
+    o_path = os.path.join(util.root(), country, f"{D}", f"{resizing}_shards")
+    m_path = masks.mask_directory(country, D, mask_threshold, resizing)
     
     if not os.path.exists(o_path):
         os.makedirs(o_path)
-        
-    greater = 1000 // 2 + D // 2
-    smaller = 1000 // 2 - D // 2
+    
+    fnames = sorted(
+        (f for f in os.listdir(i_path) if f.endswith(".jpg")),
+        key=lambda f: (len(f.split("_")[0]), f)
+    )
     
     errors = []
     
-    for i, fname in enumerate(os.listdir(i_path)):
-        if i % 1000 == 0:
-            print(f"Processed {i} file descriptors.")
-        if os.path.isfile(os.path.join(i_path, fname)):
+    for s, start in enumerate(range(0, len(fnames), shard_size)):
+        shard = fnames[start:start + shard_size]
+        if _shard_complete(o_path, s, shard, mask_threshold):
+            with np.load(os.path.join(o_path, f"shard_{s:05d}.npz")) as done:
+                errors += list(done["errors"])
+            continue
+        print(f"Packing shard {s} ({start}/{len(fnames)} chips).")
+        
+        images_file = os.path.join(o_path, f"images_{s:05d}.npy")
+        masks_file = os.path.join(o_path, f"masks_{s:05d}.npy")
+        images = util.open_memmap(images_file, np.uint8, (len(shard), D, D, 3))
+        shard_masks = None
+        if mask_threshold is not None:
+            shard_masks = util.open_memmap(masks_file, np.uint8, (len(shard), D, D))
+        
+        shard_errors = []
+        for i, fname in enumerate(shard):
             try:
-                im = Image.open(os.path.join(i_path, fname))
+                im = Image.open(os.path.join(i_path, fname)).convert("RGB")
+                if im.size != (D, D):
+                    im = im.resize((D, D), Image.NEAREST)
+                images[i] = np.asarray(im)
             except:
-                errors.append(fname)
-                continue
-
-            head, _ = os.path.splitext(fname)
-            head = head.split("_")[-1]
-                        
-            im = im.crop((smaller, smaller, greater, greater)).convert("RGB")
-        
-            im.save(os.path.join(o_path, f"{head}.jpg"), "JPEG", subsampling=subsampling, quality=quality)
-            
+                shard_errors.append(fname)
             
-    with open(os.path.join(o_path, "errors.txt"), "w") as o_err:
-        for e in errors:
-            o_err.write(f"{e}\n")
\ No newline at end of file
+            if shard_masks is not None:
+                index = fname.split("_")[0]
+                mask = cv2.imread(os.path.join(m_path, masks.mask_filename(index, country, D, mask_threshold, resizing)), cv2.IMREAD_GRAYSCALE)
+                if mask is None:
+                    shard_errors.append(fname)
+                else:
+                    shard_masks[i] = mask
+        
+        util.atomic_save(images_file, images)
+        if shard_masks is not None:
+            util.atomic_save(masks_file, shard_masks)
+        util.atomic_save(os.path.join(o_path, f"shard_{s:05d}.npz"), {
+            "filenames": np.array(shard, dtype=str),
+            "errors": np.array(shard_errors, dtype=str),
+            "mask_threshold": np.array(str(mask_threshold)),
+        })
+        errors += shard_errors
+    
+    util.atomic_save(os.path.join(o_path, "shard_size.npy"), np.array(shard_size))
+    if labels is not None:
+        util.atomic_save(os.path.join(o_path, "classes.npy"), np.array([str(labels.get(f, "")) for f in fnames]))
+    util.atomic_save(os.path.join(o_path, "errors.txt"), "".join(f"{e}\n" for e in errors))
+    util.atomic_save(os.path.join(o_path, "filenames.npy"), np.array(fnames))
@@ -0,0 +1,98 @@
+import os
+import time
+import multiprocessing
+
+import cv2
+import numpy as np
+import pandas
+
+from modules.data import util
+
+COLUMNS = ["filename", "mtime", "corrupt", "cloudy", "grayscale", "mean_r", "mean_g", "mean_b"]
+
+# per-image quality flags (cloudy, grayscale, corrupt, channel means) of an image directory
+
+def index_path(country, D=224, resizing="cropped"):
+    return os.path.join(util.root(), country, f"{D}", f"{resizing}_quality.pkl")
+
+def _inspect(path):
+    mtime = os.path.getmtime(path)
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        return mtime, True, False, False, np.nan, np.nan, np.nan
+    b, g, r, _ = cv2.mean(image)
+    cloudy = b > 150 and g > 150 and r > 150
+    grayscale = not cloudy and b == g == r
+    return mtime, False, cloudy, grayscale, r, g, b
+
+def legacy_list(country, name):
+    # cloudy.txt, grayscale.txt and corrupt.txt name either chips or the source
+    # <country>_1000x1000_<index>_<id>.tif images, possibly with a directory;
+    # both map to <index>_<id>.jpg
+    path = os.path.join(util.root(), country, f"{name}.txt")
+    if not os.path.exists(path):
+        return set()
+    names = pandas.read_csv(path, sep=" ", header=None, dtype=str)[0]
+    names = names.str.rsplit("/", n=1).str[-1].str.rsplit(".", n=1).str[0]
+    names = names.str.split("_").str[-2:].str.join("_") + ".jpg"
+    return set(names)
+
+def load_index(country, D=224, resizing="cropped"):
+    path = index_path(country, D, resizing)
+    if not os.path.exists(path):
+        return None
+    return pandas.read_pickle(path)
+
+def is_stale(index, country, D=224, resizing="cropped"):
+    # adding or removing chips updates the directory mtime, and the index must list every chip
+    i_path = os.path.join(util.root(), country, f"{D}", resizing)
+    if os.path.getmtime(i_path) > os.path.getmtime(index_path(country, D, resizing)):
+        return True
+    return sum(1 for f in os.listdir(i_path) if f.endswith(".jpg")) != len(index)
+
+def build_index(country, D=224, resizing="cropped", workers=None):
+    """
+    Create or update the quality index of data/<country>/<D>/<resizing>.
+
+    Only images that are new or modified since the last build are read,
+    using a pool of workers (all cores if None). Flags from the legacy
+    cloudy.txt, grayscale.txt and corrupt.txt lists are merged in.
+    """
+    util.validate_country(country)
+
+    i_path = os.path.join(util.root(), country, f"{D}", resizing)
+    fnames = [f for f in os.listdir(i_path) if f.endswith(".jpg")]
+    mtimes = np.array([os.path.getmtime(os.path.join(i_path, f)) for f in fnames])
+
+    index = load_index(country, D, resizing)
+    if index is None:
+        index = pandas.DataFrame(columns=COLUMNS)
+
+    previous = index.set_index("filename")["mtime"].reindex(fnames).values.astype(np.float64)
+    stale = ~(previous >= mtimes)
+    todo = [os.path.join(i_path, f) for f, s in zip(fnames, stale) if s]
+
+    rows = []
+    if todo:
+        print(f"Inspecting {len(todo)} of {len(fnames)} images.")
+        start = time.time()
+        with multiprocessing.Pool(workers) as pool:
+            rows = pool.map(_inspect, todo, chunksize=256)
+        print(f"Inspected {len(todo)} images in {time.time() - start:.1f}s.")
+
+    updated = pandas.DataFrame(rows, columns=COLUMNS[1:])
+    updated.insert(0, "filename", [os.path.basename(p) for p in todo])
+
+    current = set(fnames)
+    index = index[index["filename"].isin(current) & ~index["filename"].isin(updated["filename"])]
+    index = pandas.concat([index, updated], ignore_index=True)
+
+    for flag in ("cloudy", "grayscale", "corrupt"):
+        index[flag] = index[flag].astype(bool) | index["filename"].isin(legacy_list(country, flag))
+
+    index = index.astype({"mtime": np.float64, "mean_r": np.float32, "mean_g": np.float32, "mean_b": np.float32})
+    index = index.sort_values("filename").reset_index(drop=True)
+
+    util.atomic_save(index_path(country, D, resizing), index)
+
+    return index
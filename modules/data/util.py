@@ -31,3 +31,39 @@ def load_image_indices(country):
 def validate_country(country):
     if country != "peru" and country != "kenya":
         raise ValueError("Parameter \'country\' must be one of either \'kenya\' or \'peru\'.")
+
+def open_memmap(path, dtype, shape):
+    # memory-mapped .npy opened at <path>.tmp, moved to path by atomic_save once complete
+    return np.lib.format.open_memmap(f"{path}.tmp", mode="w+", dtype=dtype, shape=shape)
+
+def atomic_save(path, value):
+    """
+    Save value to path through <path>.tmp and os.replace, so an interrupted
+    run never leaves a partial file behind:
+        => memory maps of open_memmap(path) are flushed and moved
+        => arrays are saved as .npy, dicts of arrays as .npz
+        => dataframes are pickled
+        => strings are written as text
+        => callables are called with the temporary path, to write it
+    Caches save their filenames.npy last, which marks them as complete.
+    """
+    tmp = f"{path}.tmp"
+    if isinstance(value, np.memmap):
+        if os.path.abspath(value.filename) != os.path.abspath(tmp):
+            raise ValueError(f"Memory map must be opened with open_memmap('{path}').")
+        value.flush()
+    elif callable(value):
+        value(tmp)
+    elif hasattr(value, "to_pickle"):
+        value.to_pickle(tmp)
+    elif isinstance(value, str):
+        with open(tmp, "w") as o_file:
+            o_file.write(value)
+    elif isinstance(value, dict):
+        with open(tmp, "wb") as o_file:
+            np.savez(o_file, **value)
+    else:
+        # np.save would append .npy to a path that does not end with it
+        with open(tmp, "wb") as o_file:
+            np.save(o_file, np.asarray(value))
+    os.replace(tmp, path)
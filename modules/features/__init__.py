@@ -1 +1,3 @@
-from modules.features import simple
\ No newline at end of file
+from modules.features import simple
+from modules.features import geometry
+from modules.features import descriptors
@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import hashlib
+import multiprocessing
+
+import cv2
+import numpy as np
+import skimage.feature
+
+from modules.data import util, pipeline
+
+DESCRIPTORS = ("channel", "hog", "sift", "canny")
+
+# classical fixed-length descriptors of every chip of an image directory, computed by a pool of workers
+
+def _sift_detector():
+    # SIFT left xfeatures2d when its patent expired (opencv 4.4)
+    if hasattr(cv2, "SIFT_create"):
+        return cv2.SIFT_create()
+    return cv2.xfeatures2d.SIFT_create()
+
+def descriptor_size(name, hog_size=64, canny_grid=8):
+    if name == "channel":
+        return 6
+    elif name == "hog":
+        # 8x8 cells, overlapping 2x2 cell blocks, 9 orientations
+        return 7 * 7 * 2 * 2 * 9
+    elif name == "sift":
+        return 1 + 2 * 128
+    elif name == "canny":
+        return 1 + canny_grid * canny_grid
+    raise ValueError(f"Parameter \'descriptors\' must only contain {', '.join(DESCRIPTORS)}.")
+
+def descriptor_columns(descriptors, hog_size=64, canny_grid=8):
+    columns = []
+    for name in descriptors:
+        if name == "channel":
+            columns += ["r-mean", "g-mean", "b-mean", "r-var", "g-var", "b-var"]
+        elif name == "sift":
+            columns += ["sift-n"] + [f"sift-mean-{i}" for i in range(128)] + [f"sift-std-{i}" for i in range(128)]
+        elif name == "canny":
+            columns += ["canny-density"] + [f"canny-{i}" for i in range(canny_grid * canny_grid)]
+        else:
+            columns += [f"{name}-{i}" for i in range(descriptor_size(name, hog_size, canny_grid))]
+    return columns
+
+def channel_stats(image):
+    # RGB means then variances of a BGR image
+    pixels = image.reshape(-1, 3)[:, ::-1].astype(np.float64)
+    return np.concatenate([pixels.mean(axis=0), pixels.var(axis=0)])
+
+def hog(gray, size=64):
+    # of the chip resized to size x size, split into 8x8 cells
+    gray = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA)
+    return skimage.feature.hog(gray, orientations=9, pixels_per_cell=(size // 8, size // 8), cells_per_block=(2, 2), feature_vector=True)
+
+def sift_summary(gray, detector):
+    # keypoint count, then the mean and standard deviation of the 128-d descriptors
+    _, features = detector.detectAndCompute(gray, None)
+    if features is None or len(features) == 0:
+        return np.zeros(1 + 2 * 128)
+    return np.concatenate([[len(features)], features.mean(axis=0), features.std(axis=0)])
+
+def canny_density(gray, grid=8):
+    # edge fraction of the chip, then of each cell of a grid x grid split
+    median = np.median(gray)
+    edges = cv2.Canny(gray, (1/2) * median, (2) * median, apertureSize=3) > 0
+    h, w = edges.shape
+    cells = edges[:h // grid * grid, :w // grid * grid].reshape(grid, h // grid, grid, w // grid).mean(axis=(1, 3))
+    return np.concatenate([[edges.mean()], cells.ravel()])
+
+_worker = None
+
+def _init_worker(descriptors, hog_size, canny_grid):
+    global _worker
+    _worker = {
+        "descriptors": descriptors,
+        "hog_size": hog_size,
+        "canny_grid": canny_grid,
+        "sift": _sift_detector() if "sift" in descriptors else None,
+    }
+
+def describe(image, descriptors=DESCRIPTORS, hog_size=64, canny_grid=8, sift=None):
+    """
+    Concatenated float32 descriptors of a BGR chip, in the order of
+    descriptors.
+        => channel: RGB means and variances (6)
+        => hog: HOG of the grayscale chip resized to hog_size
+        => sift: keypoint count, mean and std of the SIFT descriptors (257)
+        => canny: edge density of the chip and of a canny_grid^2 grid
+    sift is a SIFT detector to reuse across calls.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    vectors = []
+    for name in descriptors:
+        if name == "channel":
+            vectors.append(channel_stats(image))
+        elif name == "hog":
+            vectors.append(hog(gray, hog_size))
+        elif name == "sift":
+            vectors.append(sift_summary(gray, sift or _sift_detector()))
+        elif name == "canny":
+            vectors.append(canny_density(gray, canny_grid))
+        else:
+            raise ValueError(f"Parameter \'descriptors\' must only contain {', '.join(DESCRIPTORS)}.")
+    return np.concatenate(vectors).astype(np.float32)
+
+def _describe(path):
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        # corrupt chips get a NaN row, the quality index flags them
+        size = sum(descriptor_size(name, _worker["hog_size"], _worker["canny_grid"]) for name in _worker["descriptors"])
+        return np.full(size, np.nan, dtype=np.float32)
+    return describe(image, _worker["descriptors"], _worker["hog_size"], _worker["canny_grid"], sift=_worker["sift"])
+
+def descriptor_dir(country, descriptors=DESCRIPTORS, D=224, resizing="cropped", hog_size=64, canny_grid=8):
+    key = {"descriptors": list(descriptors), "hog_size": hog_size, "canny_grid": canny_grid}
+    digest = hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(util.root(), country, f"{D}", "descriptors", f"{resizing}_{'_'.join(descriptors)}_{digest}")
+
+def load_descriptors(directory):
+    """
+    filenames and memory-mapped (n_images, n_features) float32
+    descriptors written by build_descriptors.
+    """
+    filenames = np.load(os.path.join(directory, "filenames.npy"))
+    features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+    return filenames, features
+
+def build_descriptors(country, descriptors=DESCRIPTORS, D=224, resizing="cropped", hog_size=64, canny_grid=8, workers=None, rebuild=False):
+    """
+    Compute the descriptors of every chip of data/<country>/<D>/<resizing>
+    with a pool of workers (all cores if None), unless they already are.
+    Chips are read by the workers and one row per image is written to a
+    memory-mapped features.npy, so memory does not grow with the number of
+    images. Returns the cache directory.
+    """
+    util.validate_country(country)
+    for name in descriptors:
+        descriptor_size(name, hog_size, canny_grid)
+
+    directory = descriptor_dir(country, descriptors, D, resizing, hog_size, canny_grid)
+    if os.path.exists(os.path.join(directory, "filenames.npy")) and not rebuild:
+        return directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    i_path = os.path.join(util.root(), country, f"{D}", resizing)
+    fnames = sorted(f for f in os.listdir(i_path) if f.endswith(".jpg"))
+    size = sum(descriptor_size(name, hog_size, canny_grid) for name in descriptors)
+
+    path = os.path.join(directory, "features.npy")
+    features = util.open_memmap(path, np.float32, (len(fnames), size))
+
+    start = time.time()
+    jobs = [os.path.join(i_path, f) for f in fnames]
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(tuple(descriptors), hog_size, canny_grid)) as pool:
+        for i, row in enumerate(pool.imap(_describe, jobs, chunksize=64)):
+            features[i] = row
+            if i % 1000 == 0:
+                print(f"Described {i}/{len(jobs)} images, {i / max(time.time() - start, 1e-9):.1f} images/s.")
+    util.atomic_save(path, features)
+    util.atomic_save(os.path.join(directory, "filenames.npy"), np.array(fnames, dtype=str))
+
+    print(f"Described {len(jobs)} images to {directory} in {time.time() - start:.1f}s.")
+    return directory
+
+def descriptor_split(data_manager, country, descriptors=DESCRIPTORS, hog_size=64, canny_grid=8, workers=None):
+    """
+    (X_train, y_train, X_test, y_test) for modules.models.simple.test: the
+    cached descriptors of the DataManager's sampled dataframe of a country,
+    split into training and validation like the CNN generators.
+    """
+    config = data_manager.config
+    directory = build_descriptors(
+        country, descriptors, config["image_size"], config["resizing"],
+        hog_size=hog_size, canny_grid=canny_grid, workers=workers
+    )
+    filenames, features = load_descriptors(directory)
+    rows = dict(zip(filenames, range(len(filenames))))
+
+    dataframe = data_manager.sample_dataframe(country)
+    missing = ~dataframe["filename"].isin(rows)
+    if missing.any():
+        raise ValueError(f"{missing.sum()} images of {country} are missing from {directory}, rebuild the descriptors.")
+
+    splits = []
+    for subset in ("training", "validation"):
+        part = pipeline.split(dataframe, config["validation_split"], subset)
+        positions = part["filename"].map(rows).values
+        # read the memory map in file order, then restore the dataframe order
+        order = np.argsort(positions, kind="stable")
+        X = np.empty((len(part), features.shape[1]), dtype=np.float32)
+        X[order] = features[positions[order]]
+        splits += [X, data_manager.labels(country, part)]
+
+    return tuple(splits)
@@ -0,0 +1,194 @@
+import os
+import hashlib
+
+import numpy as np
+import pandas
+
+from modules.data import util
+
+EARTH_RADIUS = 6371008.8
+
+# POLYLINE and POLYGON, with or without Z/M values: the parts and x/y points come first in all of them
+SHAPE_TYPES = (3, 5, 13, 15, 23, 25)
+
+# road geometry features of every polyline of <country>_roads.shp, computed over flattened point arrays
+
+def _gather(data, positions, dtype):
+    # one value of dtype at each byte position, read through a view of data aligned on the position's remainder
+    dtype = np.dtype(dtype)
+    values = np.empty(len(positions), dtype=dtype)
+    remainders = positions % dtype.itemsize
+    for remainder in np.unique(remainders):
+        view = np.frombuffer(data, dtype=dtype, offset=int(remainder), count=(len(data) - int(remainder)) // dtype.itemsize)
+        selected = remainders == remainder
+        values[selected] = view[(positions[selected] - remainder) // dtype.itemsize]
+    return values
+
+def _positions(starts, counts, size):
+    # byte position of every item of each record, items of size bytes stored contiguously from starts
+    first = np.cumsum(counts) - counts
+    return np.repeat(starts - size * first, counts) + size * np.arange(counts.sum())
+
+def load_polylines(country):
+    """
+    Read every polyline of <country>_roads.shp into flat arrays, without
+    creating a Python object per shape.
+        => points: (n_points, 2) lon/lat of all shapes, shape after shape
+        => point_offsets: shape i owns points[point_offsets[i]:point_offsets[i + 1]]
+        => part_offsets: first point of every part, then n_points
+        => shape_parts: shape i owns parts shape_parts[i] to shape_parts[i + 1]
+    Null shapes have no points.
+    """
+    util.validate_country(country)
+    path = os.path.join(util.root(), country, f"{country}_roads")
+
+    shx = np.fromfile(f"{path}.shx", dtype=np.uint8)
+    data = np.memmap(f"{path}.shp", dtype=np.uint8, mode="r")
+
+    # .shx records are (offset, content length) pairs of big-endian 16-bit word counts after a 100 byte header
+    records = 100 + 8 * np.arange((len(shx) - 100) // 8)
+    offsets = 2 * _gather(shx, records, ">i4").astype(np.int64)
+
+    types = _gather(data, offsets + 8, "<i4")
+    polyline = np.isin(types, SHAPE_TYPES)
+    if not np.all(polyline | (types == 0)):
+        raise ValueError(f"{path}.shp must only contain polylines or polygons.")
+
+    n_parts = np.where(polyline, _gather(data, np.where(polyline, offsets + 44, 0), "<i4"), 0).astype(np.int64)
+    n_points = np.where(polyline, _gather(data, np.where(polyline, offsets + 48, 0), "<i4"), 0).astype(np.int64)
+
+    parts_start = offsets + 52
+    points_start = parts_start + 4 * n_parts
+
+    parts = _gather(data, _positions(parts_start, n_parts, 4), "<i4").astype(np.int64)
+    x = _positions(points_start, n_points, 16)
+    points = np.stack([_gather(data, x, "<f8"), _gather(data, x + 8, "<f8")], axis=1)
+
+    point_offsets = np.concatenate([[0], np.cumsum(n_points)])
+    shape_parts = np.concatenate([[0], np.cumsum(n_parts)])
+    # part starts are relative to their shape
+    part_offsets = np.concatenate([parts + np.repeat(point_offsets[:-1], n_parts), [len(points)]])
+
+    return points, point_offsets, part_offsets, shape_parts
+
+def haversine(lon1, lat1, lon2, lat2):
+    # great circle distance in meters, angles in degrees
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _segments(points, part_offsets):
+    # local east/north vectors (meters) of consecutive points, valid where both points are in the same part
+    lon, lat = points[:, 0], points[:, 1]
+    lat_mid = np.radians((lat[:-1] + lat[1:]) / 2)
+    east = np.radians(lon[1:] - lon[:-1]) * np.cos(lat_mid) * EARTH_RADIUS
+    north = np.radians(lat[1:] - lat[:-1]) * EARTH_RADIUS
+
+    valid = np.ones(max(len(points) - 1, 0), dtype=bool)
+    ends = part_offsets[1:-1] - 1
+    valid[ends[(ends >= 0) & (ends < len(valid))]] = False
+    return east, north, valid
+
+def _turns(east, north, valid, lengths):
+    # absolute turning angle between every two consecutive segments of a part, skipping zero-length segments
+    turning = valid[:-1] & valid[1:] & (lengths[:-1] > 0) & (lengths[1:] > 0)
+    cross = east[:-1] * north[1:] - north[:-1] * east[1:]
+    dot = east[:-1] * east[1:] + north[:-1] * north[1:]
+    return np.abs(np.arctan2(cross, dot)), turning
+
+def curvature(points):
+    """
+    Total absolute turning angle, in radians, of a single (lon, lat)
+    polyline.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3:
+        return 0.0
+    east, north, valid = _segments(points, np.array([0, len(points)]))
+    angles, turning = _turns(east, north, valid, np.hypot(east, north))
+    return float(angles[turning].sum())
+
+def geometry_features(points, point_offsets, part_offsets, shape_parts):
+    """
+    Per shape features of the flat arrays of load_polylines.
+        => n_points, n_parts
+        => length: total length in meters (haversine)
+        => chord: summed start-to-end distance of the parts, in meters
+        => sinuosity: length / chord
+        => segment_mean, segment_max: segment lengths in meters
+        => curvature: total absolute turning angle in radians
+        => curvature_per_km: curvature / length in kilometers
+        => bearing_mean: length weighted mean orientation in degrees from
+           north in [0, 180), roads having no direction
+        => bearing_std: circular standard deviation of the orientation
+        => bearing_concentration: 1 for a straight road, 0 for no
+           dominant orientation
+    """
+    n_shapes = len(point_offsets) - 1
+    shape_of_point = np.repeat(np.arange(n_shapes), np.diff(point_offsets))
+
+    east, north, valid = _segments(points, part_offsets)
+    lon, lat = points[:, 0], points[:, 1]
+    lengths = haversine(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    segment_shape = shape_of_point[:-1]
+
+    n_segments = np.bincount(segment_shape[valid], minlength=n_shapes)
+    length = np.bincount(segment_shape[valid], weights=lengths[valid], minlength=n_shapes)
+    segment_max = np.zeros(n_shapes)
+    np.maximum.at(segment_max, segment_shape[valid], lengths[valid])
+
+    starts, stops = part_offsets[:-1], part_offsets[1:] - 1
+    nonempty = stops > starts
+    part_shape = np.repeat(np.arange(n_shapes), np.diff(shape_parts))
+    chords = haversine(lon[starts[nonempty]], lat[starts[nonempty]], lon[stops[nonempty]], lat[stops[nonempty]])
+    chord = np.bincount(part_shape[nonempty], weights=chords, minlength=n_shapes)
+
+    angles, turning = _turns(east, north, valid, np.hypot(east, north))
+    curvature = np.bincount(segment_shape[:-1][turning], weights=angles[turning], minlength=n_shapes)
+
+    # axial statistics: doubling the angles makes opposite directions equal
+    doubled = 2 * np.arctan2(east, north)
+    weights = np.where(valid, lengths, 0)
+    cos = np.bincount(segment_shape, weights=weights * np.cos(doubled), minlength=n_shapes)
+    sin = np.bincount(segment_shape, weights=weights * np.sin(doubled), minlength=n_shapes)
+    resultant = np.divide(np.hypot(cos, sin), length, out=np.zeros(n_shapes), where=length > 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        features = pandas.DataFrame({
+            "n_points": np.diff(point_offsets),
+            "n_parts": np.diff(shape_parts),
+            "length": length,
+            "chord": chord,
+            "sinuosity": np.where(chord > 0, length / chord, np.nan),
+            "segment_mean": np.where(n_segments > 0, length / n_segments, np.nan),
+            "segment_max": segment_max,
+            "curvature": curvature,
+            "curvature_per_km": np.where(length > 0, curvature / (length / 1000), np.nan),
+            "bearing_mean": np.where(length > 0, np.degrees(np.arctan2(sin, cos) / 2) % 180, np.nan),
+            "bearing_std": np.where(resultant > 0, np.degrees(np.sqrt(-2 * np.log(resultant)) / 2), np.nan),
+            "bearing_concentration": resultant,
+        })
+    features.index.name = "index"
+    return features
+
+def cache_path(country):
+    # keyed on the .shp/.shx modification times and sizes
+    path = os.path.join(util.root(), country, f"{country}_roads")
+    key = "|".join(f"{os.path.getmtime(f'{path}.{ext}')}:{os.path.getsize(f'{path}.{ext}')}" for ext in ("shp", "shx"))
+    digest = hashlib.md5(key.encode()).hexdigest()[:16]
+    return os.path.join(util.root(), country, f"{country}_geometry_{digest}.pkl")
+
+def load_geometry(country, rebuild=False):
+    """
+    geometry_features of every road of a country, indexed like the
+    DataManager dataframes ("index", the shapefile record), computed once
+    and cached next to the shapefile.
+    """
+    util.validate_country(country)
+    path = cache_path(country)
+    if os.path.exists(path) and not rebuild:
+        return pandas.read_pickle(path)
+
+    features = geometry_features(*load_polylines(country))
+    util.atomic_save(path, features)
+    return features
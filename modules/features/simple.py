@@ -1,21 +1,14 @@
+import cv2
 import numpy as np
+import pandas
+import matplotlib.pyplot as plt
+
+from modules.features import geometry
+from modules.features import descriptors
 
 def curvature(points):
-    radians = 0
-    
-    for i in range(1, len(points) - 1):
-        A, B, C = points[i-1:i+2]
-        a_magnitude = distance(B, C).m
-        a_euclidean = np.subtract(B, C)
-        a_euclidean *= np.divide(a_magnitude, np.linalg.norm(a_euclidean))
-        c_magnitude = distance(A, B).m
-        c_euclidean = np.subtract(A, B)
-        c_euclidean *= np.divide(c_magnitude, np.linalg.norm(c_euclidean))
-        cosine = np.dot(a_euclidean, c_euclidean) / (a_magnitude * c_magnitude)
-        angle = np.arccos(cosine)
-        radians += angle
-    
-    return radians
+    # total turning angle of one (lon, lat) polyline, see modules.features.geometry for every road at once
+    return geometry.curvature(points)
 
 def _SIFT(image, sift, plot=False):
     image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -26,7 +19,7 @@ def _SIFT(image, sift, plot=False):
 
 def SIFT(images):
     keypoints = []
-    sift = cv2.xfeatures2d.SIFT_create()
+    sift = descriptors._sift_detector()
     for image in images:
         kpts = _SIFT(image, sift)
         keypoints.append(kpts)
@@ -48,26 +41,28 @@ def canny_edge_detection(images):
         channels.append(channel)
     return np.array(channels)
 
-def location(df, fnames):
-    locations = []
-    for fname in fnames:
-        index = fname.split("_")[0]
-        locations.append(df.loc[int(index)][["lat", "lon"]].values.astype(np.float64))
-    return np.array(locations)
+def location(df, fnames, index=None):
+    """
+    lat/lon of the rows of df (indexed by shapefile record) of each image
+    filename, with one join. index is a DataManager.filename_index mapping
+    filenames to records, otherwise records are read from {index}_{id}.jpg.
+    """
+    fnames = pandas.Series(np.asarray(fnames, dtype=str))
+    if index is not None:
+        records = fnames.map(index)
+        if records.isna().any():
+            raise KeyError(f"{records.isna().sum()} filenames are missing from the filename index.")
+    else:
+        records = fnames.str.split("_", n=1).str[0]
+    return df.loc[records.values.astype(np.int64), ["lat", "lon"]].values.astype(np.float64)
 
 def channel_mean(images):
     return np.mean(images, axis=(1, 2))
 
 def channel_variance(images):
-    var = None
-    for i in range(3):
-        if var is None:
-            var = np.var(images[:, :, :, i:i+1], axis=(1, 2))
-        else:
-            var = np.concatenate([var, np.var(images[:, :, :, i:i+1], axis=(1, 2))], axis=-1)
-    return var
+    return np.var(images[:, :, :, :3], axis=(1, 2))
 
-def feature_set(images, dat, fnames, prefix=None):
+def feature_set(images, dat, fnames, prefix=None, index=None):
     """
     Extract location features and RGB channel features.
         => latitude
@@ -81,7 +76,7 @@ def feature_set(images, dat, fnames, prefix=None):
     switch to neural methods.
     """
     
-    locations = location(dat, fnames)
+    locations = location(dat, fnames, index=index)
     print("lat/lon done.")
     
     rgb_means = channel_mean(images)
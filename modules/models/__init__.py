@@ -1,2 +1,2 @@
 from modules.models import simple
-from modules.models.pretrained_cnn import pretrained_cnn, pretrained_cnn_module, pretrained_cnn_multichannel
\ No newline at end of file
+from modules.models.pretrained_cnn import pretrained_cnn, pretrained_cnn_module, pretrained_cnn_multichannel, pretrained_backbone, pretrained_head, preprocessing_layers, Preprocessing
\ No newline at end of file
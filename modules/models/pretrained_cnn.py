@@ -1,6 +1,10 @@
+import tensorflow as tf
+
 from tensorflow.keras import Sequential
 
-from tensorflow.keras.layers import Input, Flatten, Dense, Dropout, Conv2D, MaxPooling2D, BatchNormalization, Activation
+from tensorflow.keras.layers import Layer, Input, InputLayer, Flatten, Dense, Dropout, Conv2D, MaxPooling2D, BatchNormalization, Activation
+
+from modules.data.pipeline import apply_mask
 
 def pretrained_cnn_module(pretrained_type):
 
@@ -23,7 +27,58 @@ def pretrained_cnn_module(pretrained_type):
         
     return module
 
-def pretrained_cnn(config, image_size, n_channels):
+class Preprocessing(Layer):
+    """
+    The input pipeline's preprocessing, compiled into the model: takes the
+    uint8 batches of config preprocessing: model (with the road mask as a
+    fourth channel when masked), converts to grayscale if asked, applies
+    the backbone's preprocess_input and fuses the mask.
+    """
+    
+    def __init__(self, pretrained_type, grayscale=False, mask="none", mask_inverted=False, **kwargs):
+        # float32 output, also under a mixed precision policy
+        kwargs.setdefault("dtype", "float32")
+        super(Preprocessing, self).__init__(**kwargs)
+        self.pretrained_type = pretrained_type
+        self.grayscale = grayscale
+        self.mask = mask
+        self.mask_inverted = mask_inverted
+        self.preprocess_input = pretrained_cnn_module(pretrained_type).preprocess_input
+    
+    def call(self, inputs):
+        images = tf.cast(inputs, tf.float32)
+        masks = None
+        if self.mask != "none":
+            images, masks = images[:, :, :, :3], images[:, :, :, 3:]
+        if self.grayscale:
+            images = tf.image.rgb_to_grayscale(images)
+        images = self.preprocess_input(images)
+        if masks is not None:
+            images = apply_mask(images, masks, self.mask, self.mask_inverted)
+        return images
+    
+    def get_config(self):
+        config = super(Preprocessing, self).get_config()
+        config.update({
+            "pretrained_type": self.pretrained_type,
+            "grayscale": self.grayscale,
+            "mask": self.mask,
+            "mask_inverted": self.mask_inverted,
+        })
+        return config
+
+def preprocessing_layers(config, image_size):
+    # uint8 input and in-graph preprocessing for config preprocessing: model, nothing otherwise
+    if config.get("preprocessing", "pipeline") != "model":
+        return []
+    
+    channels = 3 if config["mask"] == "none" else 4
+    return [
+        InputLayer(input_shape=(image_size, image_size, channels), dtype="uint8"),
+        Preprocessing(config["pretrained"]["type"], config["use_grayscale"], config["mask"], config["mask_inverted"]),
+    ]
+
+def pretrained_backbone(config, image_size, n_channels):
     
     pretrained_type = config["pretrained"]["type"]
     
@@ -43,21 +98,61 @@ def pretrained_cnn(config, image_size, n_channels):
     if config["pretrained"]["frozen"]:
         for layer in convnet.layers:
             layer.trainable = False
+    
+    return convnet
 
-    model = Sequential(convnet)
-    model.add(Flatten())
+def pretrained_head_layers(config):
+    # fully connected classifier on top of the (flattened) backbone output
+    layers = []
     for layer in range(config["pretrained"]["fnn_layers"]):
-        model.add(Dense(config["pretrained"]["fnn_units"], activation="relu"))
-        model.add(Dropout(config["pretrained"]["dropout"]))
-    model.add(Dense(config["n_classes"], activation="softmax"))
+        layers.append(Dense(config["pretrained"]["fnn_units"], activation="relu"))
+        layers.append(Dropout(config["pretrained"]["dropout"]))
+    # float32 softmax, also under a mixed precision policy
+    layers.append(Dense(config["n_classes"], activation="softmax", dtype="float32"))
+    return layers
+
+def pretrained_head(config, n_features):
+    """
+    The classifier of pretrained_cnn on its own, for training on cached
+    backbone features; its weights transfer layer by layer.
+    """
+    model = Sequential()
+    model.add(InputLayer(input_shape=(n_features,)))
+    for layer in pretrained_head_layers(config):
+        model.add(layer)
+    
+    return model
+
+def pretrained_cnn(config, image_size, n_channels, strategy=None):
+    
+    if strategy is not None:
+        with strategy.scope():
+            return pretrained_cnn(config, image_size, n_channels)
+    
+    convnet = pretrained_backbone(config, image_size, n_channels)
+
+    front = preprocessing_layers(config, image_size)
+    if front:
+        model = Sequential(front + [convnet])
+    else:
+        model = Sequential(convnet)
+    model.add(Flatten())
+    for layer in pretrained_head_layers(config):
+        model.add(layer)
     
     return model
 
-def pretrained_cnn_multichannel(config, image_size, n_channels):
+def pretrained_cnn_multichannel(config, image_size, n_channels, strategy=None):
+    if strategy is not None:
+        with strategy.scope():
+            return pretrained_cnn_multichannel(config, image_size, n_channels)
+    
     if n_channels == 3:
         return pretrained_cnn(config, image_size, n_channels)
     
     model = Sequential()
+    for layer in preprocessing_layers(config, image_size):
+        model.add(layer)
     model.add(Conv2D(64, kernel_size=(5, 5), strides=(1, 1),
                      input_shape=(224, 224, 4)))
     model.add(BatchNormalization())
@@ -68,7 +163,7 @@ def pretrained_cnn_multichannel(config, image_size, n_channels):
     model.add(Flatten())
     model.add(Dense(256, activation="relu"))
     model.add(Dropout(config["pretrained"]["dropout"]))
-    model.add(Dense(3, activation='softmax'))
+    model.add(Dense(3, activation='softmax', dtype="float32"))
     
     return model
     
\ No newline at end of file
@@ -1,4 +1,5 @@
 from modules.run.run import *
-from modules.run.train import Trainer, Metrics
+from modules.run.train import Trainer, Metrics, ConfusionMatrix, StepCheckpoint, Telemetry
 from modules.run import predict
 from modules.run import evaluate
+from modules.run import embed
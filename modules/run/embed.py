@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from modules.run import Runner, Trainer
+from modules.data import DataManager, util, pipeline
+from tensorflow.keras import Sequential
+
+from modules.models import pretrained_backbone, pretrained_head, pretrained_cnn, preprocessing_layers
+
+# pooled backbone features computed once per image, to train only the head of a frozen backbone
+
+def weights_digest(weights):
+    # weight files are keyed on their content, named weights (imagenet) on their name
+    if not os.path.isfile(weights):
+        return None
+    digest = hashlib.md5()
+    with open(weights, "rb") as i_weights:
+        for chunk in iter(lambda: i_weights.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def embedding_key(config, country):
+    # everything that changes which images are embedded or what the backbone sees
+    masked = config["mask"] != "none"
+    weights = config["pretrained"]["weights"]
+    if weights is None:
+        raise ValueError("Cached embeddings require pretrained weights, a backbone with 'weights: None' is randomly initialized.")
+    return {
+        "country": country,
+        "type": config["pretrained"]["type"],
+        "weights": weights,
+        "weights_digest": weights_digest(weights),
+        "pooling": config["pretrained"]["pooling"],
+        "image_size": config["image_size"],
+        "n_channels": config["n_channels"],
+        "resizing": config["resizing"],
+        "use_grayscale": config["use_grayscale"],
+        "remove_clouds": config["remove_clouds"],
+        "remove_grayscale": config.get("remove_grayscale", False),
+        # cloudy.txt/grayscale.txt or the quality index flag the removed images
+        "quality_index": config.get("quality_index", False) if config["remove_clouds"] or config.get("remove_grayscale", False) else None,
+        "mask": config["mask"],
+        "mask_inverted": config["mask_inverted"] if masked else None,
+        "mask_source": config.get("mask_source", "rendered") if masked else None,
+        "mask_threshold": config.get("mask_threshold", 20) if masked else None,
+    }
+
+def embedding_dir(config, country):
+    key = embedding_key(config, country)
+    digest = hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(util.root(), country, f"{config['image_size']}", "embeddings", f"{key['type']}_{digest}")
+
+def load_embeddings(directory):
+    """
+    filenames and memory-mapped (n_images, n_features) float32 features
+    written by Embedder.embed.
+    """
+    filenames = np.load(os.path.join(directory, "filenames.npy"))
+    features = np.load(os.path.join(directory, "features.npy"), mmap_mode="r")
+    return filenames, features
+
+class Embedder(Runner):
+    """
+    Head-only training for pretrained.frozen: True. The backbone runs once
+    over every image of a country and its pooled output is cached under
+    embedding_dir(config, country); the Dense/Dropout head of pretrained_cnn
+    is then trained on the cached features by fit.
+    """
+
+    def __init__(self, config, batch_size=None):
+        super().__init__(config)
+
+        if batch_size is not None:
+            config = dict(config, batch_size=batch_size)
+        self.config = config
+
+        if not config["pretrained"]["frozen"]:
+            raise ValueError("Cached embeddings require a frozen backbone, set \'frozen: True\'.")
+        if config["pretrained"]["pooling"] not in ("avg", "max"):
+            raise ValueError("Cached embeddings require \'pooling\' to be one of either \'avg\' or \'max\'.")
+        if config["pretrained"]["weights"] is None:
+            raise ValueError("Cached embeddings require pretrained weights, a backbone with \'weights: None\' is randomly initialized.")
+
+        self.data_manager = DataManager(config)
+
+        self.backbone = None
+
+    def _embed_step(self, images):
+        # the backbone is only built when a cache is missing
+        if self.backbone is None:
+            self.backbone = pretrained_backbone(self.config, self.config["image_size"], self.config["n_channels"])
+            front = preprocessing_layers(self.config, self.config["image_size"])
+            if front:
+                self.backbone = Sequential(front + [self.backbone])
+            self._embed = tf.function(lambda images: self.backbone(images, training=False))
+        return self._embed(images)
+
+    def embed(self, country):
+        """
+        Compute and cache the features of every image of a country, unless
+        they already are. Returns the cache directory.
+        """
+        directory = embedding_dir(self.config, country)
+        if os.path.exists(os.path.join(directory, "filenames.npy")):
+            return directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        dataset, dataframe = self.data_manager.generate_inference(country)
+
+        path = os.path.join(directory, "features.npy")
+        features = None
+        offset = 0
+        t = time.time()
+        for step, (images, _) in enumerate(dataset):
+            batch = self._embed_step(images).numpy()
+            if features is None:
+                features = util.open_memmap(path, np.float32, (len(dataframe), batch.shape[1]))
+            features[offset:offset + len(batch)] = batch
+            offset += len(batch)
+            if step % 100 == 0:
+                print(f"Embedded {offset}/{len(dataframe)} images, {offset / (time.time() - t):.1f} images/s.")
+        util.atomic_save(path, features)
+        util.atomic_save(os.path.join(directory, "key.json"), json.dumps(embedding_key(self.config, country), indent=4))
+        util.atomic_save(os.path.join(directory, "filenames.npy"), dataframe["filename"].to_numpy(dtype=str))
+
+        print(f"Embedded {offset} images to {directory} in {time.time() - t:.1f}s.")
+        return directory
+
+    def generate(self, country, start_step=0):
+        """
+        Same sampling, split and labels as DataManager.generate_kenya/peru,
+        but streaming (features, one-hot label) batches from the cache.
+        start_step resumes the training stream after that many batches.
+        """
+        filenames, features = load_embeddings(self.embed(country))
+        rows = pd.Series(np.arange(len(filenames)), index=filenames)
+
+        dataframe = self.data_manager.sample_dataframe(country)
+        indices = pipeline.class_indices(dataframe)
+
+        def read(positions):
+            return np.asarray(features[positions])
+
+        datasets = []
+        for subset in ("training", "validation"):
+            part = pipeline.split(dataframe, self.config["validation_split"], subset)
+            positions = rows.reindex(part["filename"].values).values
+            if np.isnan(positions).any():
+                raise ValueError(f"Some images are missing from the embeddings of {country}, remove the cache to rebuild it.")
+
+            dataset = tf.data.Dataset.from_tensor_slices((positions.astype(np.int64), part["class"].map(indices).values.astype(np.int32)))
+            if subset == "training":
+                dataset = dataset.shuffle(len(part), seed=self.config["seed"], reshuffle_each_iteration=True)
+                dataset = dataset.repeat()
+                dataset = dataset.skip(start_step * self.config["batch_size"])
+            # a final partial validation batch cannot be split across the replicas of a tf.distribute strategy
+            drop_remainder = subset == "validation" and self.config["batch_size"] != self.config.get("replica_batch_size", self.config["batch_size"])
+            dataset = dataset.batch(self.config["batch_size"], drop_remainder=drop_remainder)
+
+            def load(positions, labels):
+                batch = tf.numpy_function(read, [positions], tf.float32)
+                batch.set_shape((None, features.shape[1]))
+                return batch, tf.one_hot(labels, len(indices))
+
+            datasets.append(dataset.map(load, num_parallel_calls=pipeline.AUTOTUNE).prefetch(pipeline.AUTOTUNE))
+
+        return datasets[0], datasets[1], dataframe
+
+    def generate_kenya(self, start_step=0):
+        return self.generate("kenya", start_step)
+
+    def generate_peru(self, start_step=0):
+        return self.generate("peru", start_step)
+
+    def _use_tfdata(self):
+        # for Trainer.fit: the cached stream always resumes at the checkpointed step
+        return True
+
+    def head(self, country, strategy=None):
+        _, features = load_embeddings(self.embed(country))
+        if strategy is not None:
+            with strategy.scope():
+                return pretrained_head(self.config, features.shape[1])
+        return pretrained_head(self.config, features.shape[1])
+
+    def fit(self, country, trainer=None, **kwargs):
+        """
+        Train the head on the cached features of a country with a Trainer
+        (its strategy, optimizer, checkpoints and callbacks), a new one for
+        the config if None. The features are batched with the trainer's
+        global batch size. Returns the trained head and the history.
+        """
+        if trainer is None:
+            trainer = Trainer(self.config)
+        self.config = trainer.config
+
+        head = trainer.compile(self.head(country, strategy=trainer.strategy))
+        history = trainer.fit(head, self, country, **kwargs)
+        return head, history
+
+    def export(self, head):
+        """
+        Full pretrained_cnn model with the weights of a head trained on the
+        cached features, to save as a regular checkpoint.
+        """
+        model = pretrained_cnn(self.config, self.config["image_size"], self.config["n_channels"])
+        for layer, trained in zip(model.layers[-len(head.layers):], head.layers):
+            layer.set_weights(trained.get_weights())
+        return model
@@ -0,0 +1,216 @@
+import os
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from modules.run import Runner, load_weights
+from modules.run.predict import load_predictions
+from modules.data import DataManager, pipeline
+from modules.models import pretrained_cnn_multichannel
+
+# classification metrics derived from a single, incrementally updated confusion matrix
+
+def confusion_matrix(y_true, y_pred, n_classes):
+    return np.bincount(
+        n_classes * np.asarray(y_true, dtype=np.int64) + np.asarray(y_pred, dtype=np.int64),
+        minlength=n_classes * n_classes
+    ).reshape(n_classes, n_classes)
+
+def _divide(numerator, denominator):
+    # zero where the denominator is zero, like sklearn's zero_division=0
+    return np.divide(numerator, denominator, out=np.zeros(len(numerator)), where=denominator > 0)
+
+def metrics(cm):
+    """
+    Accuracy and macro/micro/weighted precision, recall and F1 of a
+    confusion matrix (rows are true labels, columns predictions).
+
+    As in sklearn, the macro and weighted averages only run over classes
+    that occur in either the labels or the predictions.
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    tp = np.diag(cm)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+    total = cm.sum()
+    present = (support + predicted) > 0
+
+    precision = _divide(tp, predicted)
+    recall = _divide(tp, support)
+    f1 = _divide(2 * precision * recall, precision + recall)
+    accuracy = tp.sum() / total if total > 0 else 0.0
+
+    results = {"accuracy": accuracy}
+    for name, values in (("precision", precision), ("recall", recall), ("f1", f1)):
+        results[f"{name}_macro"] = values[present].mean() if present.any() else 0.0
+        # single-label multiclass: micro precision, recall and F1 all equal accuracy
+        results[f"{name}_micro"] = accuracy
+        results[f"{name}_weighted"] = (values * support).sum() / support.sum() if support.sum() > 0 else 0.0
+        results[f"{name}_per_class"] = values
+    return results
+
+class Evaluator:
+
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.reset()
+
+    def reset(self):
+        self.confusion_matrix = np.zeros((self.n_classes, self.n_classes), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        """
+        Add a batch. Either argument may hold class indices or
+        one-hot/probability rows.
+        """
+        y_true, y_pred = np.asarray(y_true), np.asarray(y_pred)
+        if y_true.ndim > 1:
+            y_true = np.argmax(y_true, axis=-1)
+        if y_pred.ndim > 1:
+            y_pred = np.argmax(y_pred, axis=-1)
+        self.confusion_matrix += confusion_matrix(y_true, y_pred, self.n_classes)
+        return self
+
+    def result(self):
+        return metrics(self.confusion_matrix)
+
+def cache_dataset(dataset, steps=None, path=None):
+    """
+    Read (images, one-hot labels) batches once, for at most steps batches,
+    into one array, memory-mapped at path if given (the file is sized from
+    steps, so pass steps too). Returns the images, the label indices and
+    the batch size.
+    """
+    images, labels, n = None, [], 0
+    for step, (x, y) in enumerate(dataset):
+        if steps is not None and step >= steps:
+            break
+        x = np.asarray(x)
+        if images is None:
+            # sized for every step up front, trimmed to the rows actually seen below
+            capacity = (steps or 1) * len(x)
+            if path is not None:
+                images = np.lib.format.open_memmap(path, mode="w+", dtype=x.dtype, shape=(capacity,) + x.shape[1:])
+            else:
+                images = np.empty((capacity,) + x.shape[1:], dtype=x.dtype)
+        if n + len(x) > len(images):
+            images = np.concatenate([images[:n], np.empty((max(n + len(x), 2 * n),) + x.shape[1:], dtype=x.dtype)])
+        images[n:n + len(x)] = x
+        labels.append(np.argmax(y, axis=-1))
+        n += len(x)
+    
+    if images is None:
+        raise ValueError("Cannot cache an empty dataset.")
+    return images[:n], np.concatenate(labels), len(labels[0])
+
+def evaluate_dataset(model, dataset, n_classes, steps=None):
+    """
+    Stream (images, one-hot labels) batches from a dataset or generator
+    through model and return the Evaluator.
+    """
+    evaluator = Evaluator(n_classes)
+    for step, (images, labels) in enumerate(dataset):
+        if steps is not None and step >= steps:
+            break
+        evaluator.update(labels, model.predict_on_batch(images))
+    return evaluator
+
+def evaluate_predictions(directory, n_classes=None):
+    """
+    Evaluate a prediction directory written by modules.run.predict
+    without re-running the model.
+    """
+    df = load_predictions(directory)
+    probabilities = df[[c for c in df.columns if c.startswith("p_")]].values
+    if n_classes is None:
+        n_classes = probabilities.shape[1]
+    return Evaluator(n_classes).update(df["label"].values, probabilities)
+
+class CrossDomainEvaluator(Runner):
+    """
+    Scores a set of checkpoints of one architecture on a set of target
+    datasets. The model is built once and weights are swapped in place,
+    and each target is decoded once and cached (memory-mapped under
+    cache_dir if given) for all checkpoints.
+
+    A target is a country, evaluated with the data settings of config, or a
+    (country, config) pair to use the sampling, masks and filters of another
+    config. subset is "validation" (the validation split of the sampled
+    dataframe, as seen during training) or None for every image.
+    """
+
+    def __init__(self, config, cache_dir=None, subset="validation"):
+        super().__init__(config)
+
+        self.cache_dir = cache_dir
+        self.subset = subset
+
+        self.model = pretrained_cnn_multichannel(config, image_size=config["image_size"], n_channels=config["n_channels"])
+        self._predict_step = tf.function(lambda images: self.model(images, training=False))
+
+        self._targets = {}
+
+    def _target_name(self, target):
+        if isinstance(target, str):
+            return target
+        country, config = target
+        return f"{country}_{config['name']}"
+
+    def target(self, target):
+        """
+        Cached (images, labels, batch_size) of a target.
+        """
+        name = self._target_name(target)
+        if name in self._targets:
+            return self._targets[name]
+
+        if isinstance(target, str):
+            country, config = target, self.config
+        else:
+            country, config = target
+        config = dict(config, use_kenya_images=country == "kenya", use_peru_images=country == "peru")
+
+        data_manager = DataManager(config)
+        dataframe = data_manager.sample_dataframe(country)
+        if self.subset is not None:
+            dataframe = pipeline.split(dataframe, config["validation_split"], self.subset)
+        dataset, dataframe = data_manager.generate_inference(country, dataframe=dataframe)
+
+        path = None
+        if self.cache_dir is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            path = os.path.join(self.cache_dir, f"{name}.npy")
+        steps = (len(dataframe) + config["batch_size"] - 1) // config["batch_size"]
+        images, _, batch_size = cache_dataset(dataset, steps, path)
+
+        self._targets[name] = (images, data_manager.labels(country, dataframe), batch_size)
+        return self._targets[name]
+
+    def evaluate(self, checkpoints, targets):
+        """
+        One row per (checkpoint, target) with the sample count, accuracy and
+        macro/weighted precision, recall and F1.
+        """
+        rows = []
+        for checkpoint in checkpoints:
+            load_weights(self.model, checkpoint)
+            for target in targets:
+                images, labels, batch_size = self.target(target)
+                evaluator = Evaluator(self.model.output_shape[-1])
+                for start in range(0, len(images), batch_size):
+                    stop = start + batch_size
+                    evaluator.update(labels[start:stop], self._predict_step(images[start:stop]).numpy())
+                results = evaluator.result()
+
+                row = {"checkpoint": checkpoint, "target": self._target_name(target), "n": len(images)}
+                for metric in ("accuracy", "f1_macro", "precision_macro", "recall_macro", "f1_weighted", "precision_weighted", "recall_weighted"):
+                    row[metric] = results[metric]
+                rows.append(row)
+                print(f"{checkpoint} on {row['target']}: accuracy {row['accuracy']:.4f}, f1_macro {row['f1_macro']:.4f}")
+
+        return pd.DataFrame(rows)
+
+def evaluate_cross_domain(config, checkpoints, targets, subset="validation", cache_dir=None):
+    evaluator = CrossDomainEvaluator(config, cache_dir=cache_dir, subset=subset)
+    return evaluator.evaluate(checkpoints, targets)
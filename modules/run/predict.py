@@ -0,0 +1,121 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from modules.run import Runner, load_weights
+from modules.data import DataManager, util
+from modules.models import pretrained_cnn_multichannel
+
+# batch inference of a trained checkpoint over every image of a country
+
+def load_predictions(directory):
+    """
+    Concatenate the part_XXXXX.npz files written by Predictor.predict into
+    a dataframe with filename, index, id, label and one p_<class> column
+    per output class.
+    """
+    parts = sorted(f for f in os.listdir(directory) if f.startswith("part_") and f.endswith(".npz"))
+    columns = {"filename": [], "index": [], "id": [], "label": [], "probabilities": []}
+    for part in parts:
+        with np.load(os.path.join(directory, part)) as arrays:
+            for column in columns:
+                columns[column].append(arrays[column])
+
+    probabilities = np.concatenate(columns.pop("probabilities")) if parts else np.zeros((0, 0))
+    df = pd.DataFrame({column: np.concatenate(values) if parts else [] for column, values in columns.items()})
+    for i in range(probabilities.shape[1]):
+        df[f"p_{i}"] = probabilities[:, i]
+    return df
+
+class Predictor(Runner):
+
+    def __init__(self, config, checkpoint, batch_size=None):
+        super().__init__(config)
+
+        if batch_size is not None:
+            config = dict(config, batch_size=batch_size)
+        self.config = config
+        self.checkpoint = checkpoint
+
+        self.data_manager = DataManager(config)
+
+        self.model = pretrained_cnn_multichannel(config, image_size=config["image_size"], n_channels=config["n_channels"])
+        load_weights(self.model, checkpoint)
+
+        self._predict_step = tf.function(lambda images: self.model(images, training=False))
+
+    def output_dir(self, country):
+        checkpoint = os.path.splitext(os.path.basename(self.checkpoint))[0]
+        return os.path.join("data", self.config["name"], "predictions", f"{country}_{checkpoint}")
+
+    def predict(self, country, output_dir=None, part_size=8192):
+        """
+        Score every image of a country and write the class probabilities,
+        labels and image filename/index/id to output_dir in parts of
+        part_size rows. Memory is bounded by one part, and a rerun resumes
+        after the last complete part.
+        """
+        if output_dir is None:
+            output_dir = self.output_dir(country)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        # align parts with batches so a resumed run starts on a batch boundary
+        batch_size = self.config["batch_size"]
+        part_size = max(batch_size, part_size // batch_size * batch_size)
+
+        dataframe = self.data_manager.flow_dataframe(country)
+
+        # the last part of a finished run, or of a run with another part_size, holds fewer rows
+        done = sorted(f for f in os.listdir(output_dir) if f.startswith("part_") and f.endswith(".npz"))
+        start = 0
+        for part in done:
+            with np.load(os.path.join(output_dir, part)) as arrays:
+                filenames = arrays["filename"]
+            start += len(filenames)
+        if done:
+            if not np.array_equal(filenames, dataframe["filename"].to_numpy(dtype=str)[start - len(filenames):start]):
+                raise ValueError(f"Predictions in {output_dir} do not match the current dataframe, remove them to start over.")
+
+        if start >= len(dataframe):
+            print(f"All {len(dataframe)} images already scored in {output_dir}.")
+            return output_dir
+
+        dataset, dataframe = self.data_manager.generate_inference(country, dataframe=dataframe, start=start)
+        labels = self.data_manager.labels(country, dataframe)
+
+        part = len(done)
+        probabilities = []
+        offset = 0
+        t = time.time()
+        for images, _ in dataset:
+            probabilities.append(self._predict_step(images).numpy())
+            if sum(map(len, probabilities)) >= part_size:
+                offset = self._write_part(output_dir, part, dataframe, labels, offset, probabilities)
+                part += 1
+                probabilities = []
+                print(f"Scored {start + offset}/{start + len(dataframe)} images, {offset / (time.time() - t):.1f} images/s.")
+        if probabilities:
+            self._write_part(output_dir, part, dataframe, labels, offset, probabilities)
+
+        return output_dir
+
+    def _write_part(self, output_dir, part, dataframe, labels, offset, probabilities):
+        probabilities = np.concatenate(probabilities)
+        rows = slice(offset, offset + len(probabilities))
+
+        util.atomic_save(os.path.join(output_dir, f"part_{part:05d}.npz"), {
+            "filename": dataframe["filename"].to_numpy(dtype=str)[rows],
+            "index": dataframe["index"].values[rows],
+            "id": dataframe["id"].values[rows],
+            "label": labels[rows],
+            "probabilities": probabilities,
+        })
+
+        return rows.stop
+
+def predict(config, checkpoint, country, batch_size=None, output_dir=None):
+    predictor = Predictor(config, checkpoint, batch_size=batch_size)
+    return predictor.predict(country, output_dir=output_dir)
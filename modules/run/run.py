@@ -1,5 +1,6 @@
 import os
 import yaml
+import tensorflow as tf
 
 from tensorflow.keras.losses import CategoricalCrossentropy
 
@@ -16,14 +17,82 @@ def load_config(fname):
     
     return def_dict
 
+def load_weights(model, path):
+    # Keras weight files, or the prefix of a StepCheckpoint (data/<name>/checkpoints/best/ckpt-<step>)
+    if path.endswith(".hdf5") or path.endswith(".h5"):
+        return model.load_weights(path)
+    tf.train.Checkpoint(model=model).restore(path).expect_partial()
+
+def set_precision_policy(policy):
+    # tf.keras.mixed_precision.experimental before TF 2.4
+    if hasattr(tf.keras.mixed_precision, "set_global_policy"):
+        tf.keras.mixed_precision.set_global_policy(policy)
+    else:
+        tf.keras.mixed_precision.experimental.set_policy(policy)
+
+def split_cpu(n_devices):
+    # logical CPU devices can only be configured before TensorFlow initializes its devices
+    cpu = tf.config.experimental.list_physical_devices("CPU")[0]
+    try:
+        tf.config.experimental.set_virtual_device_configuration(
+            cpu, [tf.config.experimental.VirtualDeviceConfiguration() for _ in range(n_devices)]
+        )
+    except RuntimeError:
+        if len(tf.config.experimental.list_logical_devices("CPU")) != n_devices:
+            raise ValueError("Config \'logical_cpus\' must be set before TensorFlow is first used in the process.")
 
 class Runner:
     
     def __init__(self, config):
         self.config = config
         
+        self.init_execution()
+        
         self.init_loss()
         
+    def init_execution(self):
+        # global settings, so the runner has to be created before the model is built
+        precision = self.config.get("mixed_precision", False) or "float32"
+        if precision not in ("float32", "mixed_float16", "mixed_bfloat16"):
+            raise ValueError("Config \'mixed_precision\' must be one of \'mixed_float16\', \'mixed_bfloat16\' or False.")
+        set_precision_policy(precision)
+        
+        tf.config.optimizer.set_jit(bool(self.config.get("xla", False)))
+        
+    def init_strategy(self):
+        """
+        tf.distribute strategy of config distribute:
+            => none: the default strategy, one device
+            => mirrored: data parallel over the local GPUs, or over
+               logical_cpus CPU devices when there are no GPUs
+        
+        config batch_size is per replica. self.config gets the global batch
+        size, so build the DataManager from runner.config (the model's
+        batches are split across replicas) and the model under
+        strategy.scope(), e.g. pretrained_cnn(..., strategy=runner.strategy).
+        """
+        distribute = self.config.get("distribute", "none")
+        n_cpus = self.config.get("logical_cpus", 0)
+        
+        if n_cpus:
+            split_cpu(n_cpus)
+        
+        if distribute == "none":
+            self.strategy = tf.distribute.get_strategy()
+        elif distribute == "mirrored":
+            devices = None
+            if n_cpus and not tf.config.experimental.list_physical_devices("GPU"):
+                devices = [f"/cpu:{i}" for i in range(n_cpus)]
+            self.strategy = tf.distribute.MirroredStrategy(devices)
+        else:
+            raise ValueError("Config \'distribute\' must be one of either \'none\' or \'mirrored\'.")
+        
+        if distribute != "none" and self.config.get("pipeline", "keras") == "keras":
+            raise ValueError("Config \'distribute\' requires \'pipeline: tfdata\' or \'shards\'.")
+        
+        replicas = self.strategy.num_replicas_in_sync
+        self.config = dict(self.config, batch_size=self.config["batch_size"] * replicas, replica_batch_size=self.config["batch_size"])
+        
     def init_directories(self, checkpoints=True, tensorboard=True):
         checkpoints_dir = os.path.join("data", self.config["name"], "checkpoints")
         if not os.path.isdir(checkpoints_dir):
@@ -1,57 +1,301 @@
 import os
+import json
+import time
+import warnings
 import numpy as np
 import tensorflow as tf
 
 from tensorflow.keras.callbacks import ModelCheckpoint, TensorBoard, Callback
 from tensorflow.keras.optimizers import SGD, Adam
-from sklearn.metrics import confusion_matrix, f1_score, precision_score, recall_score
-
+import modules
 from modules.run import Runner
 
+def make_optimizer(config):
+    if config["optimizer"] == "sgd":
+        optimizer = SGD(learning_rate=config["learning_rate"])
+    elif config["optimizer"] == "adam":
+        optimizer = Adam(learning_rate=config["learning_rate"])
+    else:
+        raise ValueError
+    
+    # float16 gradients underflow without loss scaling, bfloat16 has the range of float32
+    if config.get("mixed_precision", False) == "mixed_float16":
+        if hasattr(tf.keras.mixed_precision, "LossScaleOptimizer"):
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        else:
+            optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale="dynamic")
+    
+    return optimizer
+
+class ConfusionMatrix(tf.keras.metrics.Metric):
+    """
+    Compiled metric that accumulates the confusion matrix of every batch it
+    sees, so the validation pass Keras already runs at the end of an epoch
+    yields all classification metrics without another forward pass. Its
+    scalar result is the macro F1; sample weights are ignored.
+    """
+    
+    def __init__(self, n_classes, name="f1_macro", **kwargs):
+        super(ConfusionMatrix, self).__init__(name=name, **kwargs)
+        self.n_classes = n_classes
+        self.matrix = self.add_weight(name="matrix", shape=(n_classes, n_classes), initializer="zeros")
+    
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        matrix = tf.math.confusion_matrix(
+            tf.argmax(y_true, axis=-1), tf.argmax(y_pred, axis=-1), num_classes=self.n_classes, dtype=self.matrix.dtype
+        )
+        self.matrix.assign_add(matrix)
+    
+    def result(self):
+        tp = tf.linalg.diag_part(self.matrix)
+        support = tf.reduce_sum(self.matrix, axis=1)
+        predicted = tf.reduce_sum(self.matrix, axis=0)
+        precision = tf.math.divide_no_nan(tp, predicted)
+        recall = tf.math.divide_no_nan(tp, support)
+        f1 = tf.math.divide_no_nan(2 * precision * recall, precision + recall)
+        present = tf.cast(support + predicted > 0, f1.dtype)
+        return tf.math.divide_no_nan(tf.reduce_sum(f1 * present), tf.reduce_sum(present))
+    
+    def reset_states(self):
+        self.matrix.assign(tf.zeros_like(self.matrix))
+    
+    reset_state = reset_states
+
 class Metrics(Callback):
+    """
+    Logs F1/precision/recall variants of the validation set every epoch,
+    all derived from one confusion matrix.
     
-    def __init__(self, val_data, tensorboard_dir, val_labels, n_epochs):
+    If the model was compiled with a ConfusionMatrix metric, pass it as
+    confusion_matrix and the matrix of Keras' own validation pass is used.
+    Otherwise the validation batches are decoded once (val_steps of them,
+    or the whole iterator), cached in memory, or memory-mapped at
+    cache_path, and scored with a single batched predict each epoch.
+    """
+    
+    def __init__(self, val_data, tensorboard_dir, val_labels=None, val_steps=None, confusion_matrix=None, cache_path=None):
         super(Metrics, self).__init__()
         self.validation_data = val_data
         self.logdir = tensorboard_dir
         self.file_writer = tf.summary.create_file_writer(self.logdir + '/validation/metrics')
         self.file_writer.set_as_default()
         self.val_labels = val_labels
-        self.num_epochs = n_epochs
+        self.val_steps = val_steps
+        self.confusion_matrix = confusion_matrix
+        self.cache_path = cache_path
+        self._cache = None
     
     def on_train_begin(self, logs={}):
         self.val_f1s = []
         self.val_recalls = []
         self.val_precisions = []
-
-    def on_epoch_end(self, epoch, logs={}):
-        val_predict = None
-        val_targ = None
+    
+    def _cache_validation_data(self):
+        steps = self.val_steps
+        if steps is None and hasattr(self.validation_data, "__len__"):
+            steps = len(self.validation_data)
         
+        images, targets, batch_size = modules.run.evaluate.cache_dataset(self.validation_data, steps, self.cache_path)
         if self.val_labels is not None:
-            val_predict = np.argmax(self.model.predict(self.validation_data, steps=self.num_epochs), axis=1)
-            val_targ = self.val_labels
-        else:
-            val_predict = np.argmax(self.model.predict(self.validation_data), axis=1)
-            val_targ = self.validation_data.labels
+            targets = np.asarray(self.val_labels)[:len(images)]
+        self._cache = (images, targets, batch_size)
+    
+    def _predict_confusion_matrix(self):
+        if self._cache is None:
+            self._cache_validation_data()
+        images, targets, batch_size = self._cache
+        predictions = np.argmax(self.model.predict(images, batch_size=batch_size), axis=1)
+        return modules.run.evaluate.confusion_matrix(targets, predictions, self.model.output_shape[-1])
 
-        _val_f1 = f1_score(val_targ, val_predict, average='macro')
-        _val_f1_micro = f1_score(val_targ, val_predict, average='micro')
-        _val_f1_weighted = f1_score(val_targ, val_predict, average='weighted')
-        _val_recall = recall_score(val_targ, val_predict, average='macro')
-        _val_precision = precision_score(val_targ, val_predict, average='macro')
+    def on_epoch_end(self, epoch, logs={}):
+        if self.confusion_matrix is not None:
+            cm = np.asarray(self.confusion_matrix.matrix.numpy())
+        else:
+            cm = self._predict_confusion_matrix()
+        
+        results = modules.run.evaluate.metrics(cm)
+        _val_f1 = results["f1_macro"]
+        _val_recall = results["recall_macro"]
+        _val_precision = results["precision_macro"]
         self.val_f1s.append(_val_f1)
         self.val_recalls.append(_val_recall)
         self.val_precisions.append(_val_precision)
         print (" — val_f1: %f — val_precision: %f — val_recall %f" % (_val_f1, _val_precision, _val_recall))
         
-        tf.summary.scalar('f1_macro', data=_val_f1, step=epoch)
-        tf.summary.scalar('f1_micro', data=_val_f1_micro, step=epoch)
-        tf.summary.scalar('f1_weighted', data=_val_f1_weighted, step=epoch)
+        for name in ("f1", "precision", "recall"):
+            for average in ("macro", "micro", "weighted"):
+                tf.summary.scalar(f"{name}_{average}", data=results[f"{name}_{average}"], step=epoch)
         self.file_writer.flush()
         
         return _val_f1
 
+def _checkpoint_options():
+    # background checkpoint writes need TF 2.9, before that they are synchronous
+    try:
+        return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+    except (AttributeError, TypeError):
+        return None
+
+class StepCheckpoint(Callback):
+    """
+    Saves the model weights, the optimizer state and the global step every
+    save_steps batches and at the end of every epoch with
+    tf.train.Checkpoint. Checkpoints are written in the background when
+    TensorFlow supports it (TF 2.9 and variables it can snapshot), and
+    synchronously otherwise, which is warned about once. The data position
+    follows from the step (see start_step of DataManager.generate_kenya/peru).
+        => <directory>/last keeps the keep_last most recent checkpoints
+        => <directory>/best keeps the keep_best checkpoints with the best
+           monitor value at the end of an epoch (lowest for mode "min")
+    """
+    
+    def __init__(self, directory, save_steps=1000, keep_last=3, keep_best=1, monitor="val_loss", mode="min"):
+        super(StepCheckpoint, self).__init__()
+        self.directory = directory
+        self.save_steps = save_steps
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.monitor = monitor
+        self.sign = 1 if mode == "min" else -1
+        self.options = _checkpoint_options()
+        
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = None
+        self._step = 0
+        self._saved = None
+    
+    def _track(self, model):
+        if self.checkpoint is None:
+            self.checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer, step=self.step)
+            self.manager = tf.train.CheckpointManager(self.checkpoint, os.path.join(self.directory, "last"), max_to_keep=self.keep_last)
+        return self.checkpoint
+    
+    def restore(self, model):
+        """
+        Restore the latest checkpoint into a compiled model and return the
+        step to resume from, 0 if there is none.
+        """
+        self._track(model)
+        if self.manager.latest_checkpoint is None:
+            return 0
+        self.checkpoint.restore(self.manager.latest_checkpoint)
+        self._step = self._saved = int(self.step.numpy())
+        print(f"Restored {self.manager.latest_checkpoint} at step {self._step}.")
+        return self._step
+    
+    def _write(self, save, *args, **kwargs):
+        if self.options is not None:
+            try:
+                return save(*args, options=self.options, **kwargs)
+            except (ValueError, TypeError) as e:
+                # some variable types cannot be snapshotted for a background write
+                warnings.warn(
+                    f"TensorFlow {tf.__version__} cannot write the checkpoints of this model in the background ({e.__class__.__name__}), "
+                    f"every save of {self.directory} now blocks training."
+                )
+                self.options = None
+        return save(*args, **kwargs)
+    
+    def _save_last(self):
+        if self._saved == self._step:
+            return
+        self.step.assign(self._step)
+        self._write(self.manager.save, checkpoint_number=self._step)
+        self._saved = self._step
+    
+    def _save_best(self, value):
+        best_dir = os.path.join(self.directory, "best")
+        index_path = os.path.join(best_dir, "best.json")
+        best = []
+        if os.path.exists(index_path):
+            with open(index_path) as i_best:
+                best = json.load(i_best)
+        if len(best) >= self.keep_best and self.sign * value >= max(self.sign * b["value"] for b in best):
+            return
+        
+        self.step.assign(self._step)
+        prefix = os.path.join(best_dir, f"ckpt-{self._step}")
+        self._write(self.checkpoint.write, prefix)
+        
+        best = sorted(best + [{"step": self._step, "value": float(value), "path": prefix}], key=lambda b: self.sign * b["value"])
+        for b in best[self.keep_best:]:
+            for path in tf.io.gfile.glob(b["path"] + ".*"):
+                tf.io.gfile.remove(path)
+        
+        modules.data.util.atomic_save(index_path, json.dumps(best[:self.keep_best], indent=4))
+    
+    def on_train_begin(self, logs=None):
+        self._track(self.model)
+        self._step = int(self.step.numpy())
+    
+    def on_train_batch_end(self, batch, logs=None):
+        self._step += 1
+        if self._step % self.save_steps == 0:
+            self._save_last()
+    
+    def on_epoch_end(self, epoch, logs=None):
+        self._save_last()
+        value = (logs or {}).get(self.monitor)
+        if self.keep_best and value is not None:
+            self._save_best(value)
+    
+    def on_train_end(self, logs=None):
+        self._save_last()
+        # wait for the background writes
+        if hasattr(self.checkpoint, "sync"):
+            self.checkpoint.sync()
+
+class Telemetry(Callback):
+    """
+    Low-overhead TensorBoard telemetry, written to <logdir>/telemetry.
+        => step time and images/s every throughput_freq batches, timed on
+           the host, averaged over the batches since the last point
+        => every histogram_freq epochs, histograms of histogram_layers
+           evenly spaced weight tensors, each subsampled to at most
+           histogram_samples values
+    """
+    
+    def __init__(self, logdir, batch_size, throughput_freq=50, histogram_freq=0, histogram_layers=8, histogram_samples=10000, seed=0):
+        super(Telemetry, self).__init__()
+        self.writer = tf.summary.create_file_writer(os.path.join(logdir, "telemetry"))
+        self.batch_size = batch_size
+        self.throughput_freq = throughput_freq
+        self.histogram_freq = histogram_freq
+        self.histogram_layers = histogram_layers
+        self.histogram_samples = histogram_samples
+        self.random = np.random.RandomState(seed)
+        self._step = 0
+    
+    def on_epoch_begin(self, epoch, logs=None):
+        # validation and epoch-end callbacks are not training time
+        self._time = time.time()
+        self._window = 0
+    
+    def on_train_batch_end(self, batch, logs=None):
+        self._step += 1
+        self._window += 1
+        if self.throughput_freq and self._step % self.throughput_freq == 0:
+            now = time.time()
+            step_time = (now - self._time) / self._window
+            with self.writer.as_default():
+                tf.summary.scalar("step_time", step_time, step=self._step)
+                tf.summary.scalar("images_per_second", self.batch_size / step_time, step=self._step)
+            self._time = now
+            self._window = 0
+    
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.histogram_freq or (epoch + 1) % self.histogram_freq != 0:
+            return
+        weights = self.model.trainable_weights
+        picks = np.unique(np.linspace(0, len(weights) - 1, min(self.histogram_layers, len(weights))).astype(int))
+        with self.writer.as_default():
+            for i in picks:
+                values = np.ravel(weights[i].numpy())
+                if len(values) > self.histogram_samples:
+                    values = values[self.random.randint(0, len(values), self.histogram_samples)]
+                tf.summary.histogram(getattr(weights[i], "path", weights[i].name), values, step=epoch)
+        self.writer.flush()
+
 class Trainer(Runner):
     
     def __init__(self, *args, **kwargs):
@@ -60,39 +304,147 @@ class Trainer(Runner):
         checkpoints = True
         tensorboard = True
         
+        self.init_strategy()
+        
         self.init_directories(checkpoints, tensorboard)
         
         self.init_callbacks(checkpoints, tensorboard)
         
-        self.init_optimizer()
+        # optimizer and metric variables are mirrored, so they are created in the strategy scope
+        with self.strategy.scope():
+            self.init_optimizer()
+            
+            self.init_metrics()
+        
+        # reads the validation confusion matrix of the compiled ConfusionMatrix
+        self.metrics_callback = Metrics(None, self.tensorboard_dir, confusion_matrix=self.confusion_matrix)
+        self.callbacks.append(self.metrics_callback)
         
         self.validation_data = args[-1]
         
     def init_callbacks(self, checkpoints=True, tensorboard=True):
+        # full: every weight histogram, the graph and the weight images every epoch
+        # sampled: Telemetry histograms and throughput
+        # throughput: Telemetry step time and images/s only
+        telemetry = self.config.get("telemetry", {})
+        mode = telemetry.get("mode", "full")
+        if mode not in ("full", "sampled", "throughput"):
+            raise ValueError("Config \'telemetry: mode\' must be one of \'full\', \'sampled\' or \'throughput\'.")
+        
+        kwargs = {}
+        if "profile_batch" in telemetry:
+            # the TF profiler trace of one batch or a [first, last] window of batches, 0 for none
+            profile_batch = telemetry["profile_batch"]
+            kwargs["profile_batch"] = tuple(profile_batch) if isinstance(profile_batch, list) else profile_batch
+        
         self.tensorboard_callback = TensorBoard(
             self.tensorboard_dir,
-            histogram_freq=1,
-            write_graph=True,
-            write_images=True,
-            update_freq=self.config["batch_size"] * self.config["tensorboard_freq"]
-        )
-
-        self.checkpoints_callback = ModelCheckpoint(
-            os.path.join(self.checkpoints_dir, "weights.{epoch:02d}-{val_loss:.2f}.hdf5"),
-            monitor='val_loss',
-            save_best_only=False,
-            save_weights_only=True,
-            save_freq='epoch',
+            histogram_freq=1 if mode == "full" else 0,
+            write_graph=mode == "full",
+            write_images=mode == "full",
+            update_freq=self.config["batch_size"] * self.config["tensorboard_freq"],
+            **kwargs
         )
         
-#         self.metrics_callback = Metrics(self.validation_data)
+        self.telemetry_callback = None
+        if mode != "full":
+            self.telemetry_callback = Telemetry(
+                self.tensorboard_dir,
+                self.config["batch_size"],
+                throughput_freq=telemetry.get("throughput_freq", self.config["tensorboard_freq"]),
+                histogram_freq=telemetry.get("histogram_freq", 1) if mode == "sampled" else 0,
+                histogram_layers=telemetry.get("histogram_layers", 8),
+                histogram_samples=telemetry.get("histogram_samples", 10000),
+                seed=self.config["seed"],
+            )
+
+        if self.config.get("checkpoint_steps", 0):
+            self.checkpoints_callback = StepCheckpoint(
+                self.checkpoints_dir,
+                save_steps=self.config["checkpoint_steps"],
+                keep_last=self.config.get("keep_last", 3),
+                keep_best=self.config.get("keep_best", 1),
+                monitor='val_loss',
+            )
+        else:
+            self.checkpoints_callback = ModelCheckpoint(
+                os.path.join(self.checkpoints_dir, "weights.{epoch:02d}-{val_loss:.2f}.hdf5"),
+                monitor='val_loss',
+                save_best_only=False,
+                save_weights_only=True,
+                save_freq='epoch',
+            )
         
-        self.callbacks = [self.tensorboard_callback, self.checkpoints_callback] #self.metrics_callback]
+        self.callbacks = [self.tensorboard_callback, self.checkpoints_callback]
+        if self.telemetry_callback is not None:
+            self.callbacks.append(self.telemetry_callback)
+    
+    def init_metrics(self):
+        # compile with trainer.metrics so Metrics can read the validation confusion matrix
+        self.confusion_matrix = ConfusionMatrix(self.config["n_classes"])
+        self.metrics = [self.confusion_matrix]
+        self.weighted_metrics = list(self.config["weighted_metrics"] or [])
     
     def init_optimizer(self):
-        if self.config["optimizer"] == "sgd":
-            self.optimizer = SGD(learning_rate=self.config["learning_rate"])
-        elif self.config["optimizer"] == "adam":
-            self.optimizer = Adam(learning_rate=self.config["learning_rate"])
-        else:
-            raise ValueError
\ No newline at end of file
+        self.optimizer = make_optimizer(self.config)
+    
+    def compile(self, model, **kwargs):
+        # compiles in the strategy scope, with the trainer's loss, optimizer and metrics
+        kwargs.setdefault("metrics", self.metrics)
+        kwargs.setdefault("weighted_metrics", self.weighted_metrics)
+        # config xla compiles the train step, the global jit setting of Runner only clusters graphs on GPUs
+        kwargs.setdefault("jit_compile", bool(self.config.get("xla", False)))
+        with self.strategy.scope():
+            try:
+                model.compile(loss=self.loss, optimizer=self.optimizer, **kwargs)
+            except TypeError:
+                # no jit_compile before TF 2.5
+                kwargs.pop("jit_compile")
+                model.compile(loss=self.loss, optimizer=self.optimizer, **kwargs)
+        return model
+    
+    def restore(self, model):
+        # step of the latest step checkpoint, restored into model, 0 without one
+        if not isinstance(self.checkpoints_callback, StepCheckpoint):
+            return 0
+        return self.checkpoints_callback.restore(model)
+    
+    def fit(self, model, data_manager, country, steps_per_epoch=None, **kwargs):
+        """
+        Train a compiled model for config n_epochs on the generators of
+        data_manager for a country. With config resume, training continues
+        from the latest step checkpoint: weights, optimizer state and the
+        position in the tf.data/shards training stream are restored, and
+        the interrupted epoch is finished before the remaining ones.
+        """
+        generate = data_manager.generate_kenya if country == "kenya" else data_manager.generate_peru
+        
+        step = 0
+        if self.config.get("resume", False):
+            step = self.restore(model)
+            if step and not data_manager._use_tfdata():
+                print("The keras pipeline cannot skip to the checkpointed step, its data order restarts.")
+        
+        train_data, validation_data, dataframe = generate(start_step=step)
+        if steps_per_epoch is None:
+            steps_per_epoch = int(len(dataframe) * (1 - self.config["validation_split"])) // self.config["batch_size"] + 1
+        epochs = self.config["n_epochs"]
+        epoch, offset = divmod(step, steps_per_epoch)
+        
+        history = None
+        if offset:
+            # finish the interrupted epoch, then restart the stream at the next epoch boundary
+            history = model.fit(
+                train_data, steps_per_epoch=steps_per_epoch - offset, epochs=epoch + 1, initial_epoch=epoch,
+                validation_data=validation_data, callbacks=self.callbacks, **kwargs
+            )
+            epoch += 1
+            if epoch < epochs:
+                train_data, validation_data, _ = generate(start_step=epoch * steps_per_epoch)
+        if epoch < epochs:
+            history = model.fit(
+                train_data, steps_per_epoch=steps_per_epoch, epochs=epochs, initial_epoch=epoch,
+                validation_data=validation_data, callbacks=self.callbacks, **kwargs
+            )
+        
+        return history
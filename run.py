@@ -1,4 +1,5 @@
 import os
+import math
 import tensorflow as tf
 
 from modules.run import load_config
@@ -15,24 +16,23 @@ import cv2
 
 print(tf.test.is_gpu_available())
 
-with tf.device('device:GPU:0'):
-
-    config = load_config("cls_w6_e2")
-    data_manager = DataManager(config)
-    convnet = pretrained_cnn(config, image_size=config["image_size"], n_channels=config["n_channels"])
-    trainer = Trainer(config)
-    train_generator, val_generator = data_manager.generate_kenya()
-
-    convnet.compile(loss=trainer.loss, weighted_metrics=['accuracy'], optimizer=trainer.optimizer)
-
-    convnet.summary()
-
-    convnet.fit_generator(
-        train_generator, 
-        config["sample"]["size"] * (1 - config["validation_split"]) // config["batch_size"],
-        epochs=config["n_epochs"],
-        callbacks=trainer.callbacks, 
-        validation_data=val_generator, 
-        validation_steps=config["sample"]["size"] * (config["validation_split"]) // config["batch_size"],
-        class_weight=data_manager.class_weight("kenya")
-    )
+# the trainer picks the devices (config distribute), so it is created first
+config = load_config("cls_w6_e2")
+trainer = Trainer(config)
+data_manager = DataManager(trainer.config)
+convnet = pretrained_cnn(trainer.config, image_size=config["image_size"], n_channels=config["n_channels"], strategy=trainer.strategy)
+train_generator, val_generator, dataframe = data_manager.generate_kenya()
+
+trainer.compile(convnet, weighted_metrics=['accuracy'])
+
+convnet.summary()
+
+convnet.fit(
+    train_generator, 
+    steps_per_epoch=int(math.ceil(config["sample"]["size"] * (1 - config["validation_split"]) / trainer.config["batch_size"])),
+    epochs=config["n_epochs"],
+    callbacks=trainer.callbacks, 
+    validation_data=val_generator, 
+    validation_steps=int(math.ceil(config["sample"]["size"] * config["validation_split"] / trainer.config["batch_size"])),
+    class_weight=data_manager.class_weight("kenya")
+)
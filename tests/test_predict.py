@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from modules.run.predict import Predictor, load_predictions
+
+N_ROWS = 44
+BATCH_SIZE = 4
+PART_SIZE = 16
+
+class FakeDataManager:
+    # 44 images whose single pixel is their row number, stream cut after stop rows
+    def __init__(self, stop=None):
+        self.stop = stop
+
+    def flow_dataframe(self, country):
+        return pd.DataFrame({
+            "filename": [f"{i}_{1000 + i}.jpg" for i in range(N_ROWS)],
+            "class": ["0"] * N_ROWS,
+            "index": np.arange(N_ROWS),
+            "id": 1000 + np.arange(N_ROWS),
+        })
+
+    def generate_inference(self, country, dataframe=None, start=0):
+        dataframe = dataframe.iloc[start:]
+        stop = len(dataframe) if self.stop is None else self.stop - start
+        rows = dataframe["index"].values[:stop].astype(np.float32)
+        batches = [(rows[i:i + BATCH_SIZE, None], None) for i in range(0, len(rows), BATCH_SIZE)]
+        return batches, dataframe
+
+    def labels(self, country, dataframe):
+        return np.zeros(len(dataframe), dtype=np.int64)
+
+def predictor(data_manager):
+    # the model is replaced by a step returning the row number, to check alignment
+    predictor = Predictor.__new__(Predictor)
+    predictor.config = {"batch_size": BATCH_SIZE, "name": "test"}
+    predictor.checkpoint = "test.hdf5"
+    predictor.data_manager = data_manager
+    predictor._predict_step = lambda images: tf.concat([images, 1 - images], axis=1)
+    return predictor
+
+def check(directory):
+    df = load_predictions(directory)
+    assert len(df) == N_ROWS
+    assert list(df["index"]) == list(range(N_ROWS))
+    assert np.array_equal(df["p_0"].values, np.arange(N_ROWS))
+    assert list(df["filename"]) == [f"{i}_{1000 + i}.jpg" for i in range(N_ROWS)]
+
+def test_rerun_on_finished_directory(tmp_path):
+    directory = str(tmp_path)
+    predictor(FakeDataManager()).predict("kenya", output_dir=directory, part_size=PART_SIZE)
+    # 16 + 16 + 12 rows, the last part is partial
+    check(directory)
+
+    predictor(FakeDataManager()).predict("kenya", output_dir=directory, part_size=PART_SIZE)
+    check(directory)
+
+def test_resume_after_partial_last_part(tmp_path):
+    directory = str(tmp_path)
+    # interrupted after 40 rows: 16 + 16 + 8
+    predictor(FakeDataManager(stop=40)).predict("kenya", output_dir=directory, part_size=PART_SIZE)
+    assert len(load_predictions(directory)) == 40
+
+    predictor(FakeDataManager()).predict("kenya", output_dir=directory, part_size=PART_SIZE)
+    check(directory)